@@ -0,0 +1,278 @@
+# Offline benchmark for the travel planner API. No Gemini quota is used: the shared
+# model client is replaced by a local fake that replays sections of the recorded plans
+# in logs/ with configurable latency and error rate, and the FastAPI app is driven
+# in-process at a fixed concurrency.
+#
+# Install: pip install httpx
+# Run:     python benchmark.py --requests 200 --concurrency 20 --latency lognormal:0.7,0.4
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import re
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+import main
+
+LOGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+
+# Size of the pieces a streamed fake response is delivered in
+STREAM_CHUNK_CHARS = 200
+
+INTEREST_OPTIONS = ["Adventure", "Culture", "Food", "Nature", "History", "Relaxation", "Shopping", "Nightlife"]
+
+# Prompt openings used to tell which agent a prompt came from
+PROMPT_SECTIONS = [
+    ("team of travel experts", "fused"),
+    ("expert travel planner", "plan"),
+    ("transportation booking expert", "transportation"),
+    ("hotel booking expert", "accommodation"),
+    ("local tourism expert", "attractions"),
+    ("local food expert", "restaurants"),
+    ("itinerary planning expert", "activities"),
+    ("You are a local expert for", "localTips"),
+]
+
+class LatencyModel:
+    """Samples simulated model latency in seconds from a spec such as
+    "fixed:0.5", "uniform:0.2,1.5", "normal:0.8,0.2" or "lognormal:-0.3,0.5"."""
+    def __init__(self, spec: str, rng: random.Random):
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p]
+        self.rng = rng
+        if kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {kind}")
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return self.rng.uniform(*self.params)
+        if self.kind == "normal":
+            return max(0.0, self.rng.gauss(*self.params))
+        return self.rng.lognormvariate(*self.params)
+
+class FakeModelClient(main.ModelClient):
+    """ModelClient whose upstream call replays recorded plan sections.
+
+    Only the network call is replaced, so concurrency limits, retries and the
+    circuit breaker behave as they do in production.
+    """
+    def __init__(self, plans: List[dict], latency: LatencyModel, error_rate: float, rng: random.Random,
+                 seconds_per_1k_prompt_tokens: float = 0.0):
+        super().__init__()
+        self.method = "fake"
+        self.plans = plans
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = rng
+        self.seconds_per_1k_prompt_tokens = seconds_per_1k_prompt_tokens
+
+    async def probe(self, model_name: str) -> str:
+        self.resolved[model_name] = model_name
+        return model_name
+
+    async def _call(self, model_name: str, prompt: str, on_text=None, generation_config=None) -> str:
+        prompt_seconds = main.estimate_tokens(prompt) / 1000 * self.seconds_per_1k_prompt_tokens
+        await asyncio.sleep(self.latency.sample() + prompt_seconds)
+        if self.rng.random() < self.error_rate:
+            if main.GOOGLE_API_ERRORS_AVAILABLE:
+                raise main.google_exceptions.ServiceUnavailable("Injected benchmark error")
+            raise RuntimeError("Injected benchmark error")
+        text = json.dumps(self._response(prompt))
+        if on_text is not None:
+            for start in range(0, len(text), STREAM_CHUNK_CHARS):
+                await on_text(text[start:start + STREAM_CHUNK_CHARS])
+        return text
+
+    def _response(self, prompt: str):
+        plan = self.rng.choice(self.plans)
+        section = next((name for marker, name in PROMPT_SECTIONS if marker in prompt), "plan")
+        if section == "fused":
+            return {
+                "plan": self._section(plan, "plan", prompt),
+                "transportation": plan.get("transportation", {}),
+                "accommodation": plan.get("accommodation", {}),
+                "attractions": plan.get("attractions", []),
+                "restaurants": plan.get("restaurants", []),
+                "tips": plan.get("localTips", []),
+            }
+        return self._section(plan, section, prompt)
+
+    def _section(self, plan: dict, section: str, prompt: str):
+        if section == "plan":
+            return {"duration": plan.get("duration", 0), "overview": plan.get("overview", {})}
+        if section == "activities":
+            days = re.search(r"Days: (\d+) to (\d+)", prompt)
+            duration = re.search(r"Duration: (\d+) days", prompt)
+            first, last = (int(days.group(1)), int(days.group(2))) if days else (1, int(duration.group(1)) if duration else 3)
+            recorded = plan.get("activities") or [{"morning": "Explore", "afternoon": "Museum", "evening": "Dinner"}]
+            return [{**recorded[i % len(recorded)], "day": day} for i, day in enumerate(range(first, last + 1))]
+        return plan.get(section, [])
+
+def load_recorded_plans() -> List[dict]:
+    plans = []
+    for path in sorted(glob.glob(os.path.join(LOGS_DIR, "*.json"))):
+        with open(path) as f:
+            plans.append(json.load(f))
+    if not plans:
+        raise SystemExit(f"No recorded plans found in {LOGS_DIR}")
+    return plans
+
+def build_requests(plans: List[dict], count: int, rng: random.Random) -> List[dict]:
+    """Request bodies modelled on the recorded plans' destinations, dates and travelers"""
+    requests = []
+    for _ in range(count):
+        plan = rng.choice(plans)
+        overview = plan.get("overview", {})
+        requests.append({
+            "destination": plan.get("destination", "Paris").strip(),
+            "startDate": overview.get("startDate", "2025-11-28"),
+            "endDate": overview.get("endDate", "2025-12-03"),
+            "travelers": overview.get("travelers", 2),
+            "budget": str(overview.get("totalCost", "3000")),
+            "interests": rng.sample(INTEREST_OPTIONS, rng.randint(0, 3)),
+        })
+    return requests
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summarize(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4) if values else 0.0,
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+    }
+
+def prompt_tokens_by_agent() -> Dict[str, float]:
+    """Mean estimated prompt tokens per model call, per agent role"""
+    means = {}
+    with main.AGENT_PROMPT_TOKENS.lock:
+        for (role,), (_, total, count) in main.AGENT_PROMPT_TOKENS.values.items():
+            means[role] = round(total / count, 1) if count else 0.0
+    return means
+
+def instrument_agents(agent_times: Dict[str, List[float]]):
+    """Record wall time of every Agent.run call, per agent role"""
+    original_run = main.Agent.run
+
+    async def timed_run(self, request, *inputs):
+        started = time.monotonic()
+        try:
+            return await original_run(self, request, *inputs)
+        finally:
+            agent_times.setdefault(self.role, []).append(time.monotonic() - started)
+
+    main.Agent.run = timed_run
+
+async def run_benchmark(args) -> dict:
+    rng = random.Random(args.seed)
+    plans = load_recorded_plans()
+    # The transport does not run the app's lifespan, so build the services here
+    main.initialize()
+    main.model_client = FakeModelClient(plans, LatencyModel(args.latency, rng), args.error_rate, rng,
+                                        args.prompt_latency)
+    main.COMPACT_PROMPTS = not args.full_prompts
+    main.model_client.scheduler = main.ModelScheduler(
+        args.rate_per_minute, main.GEMINI_RATE_BURST, main.GEMINI_MAX_CONCURRENCY, main.MODEL_QUEUE_SIZE)
+    if args.no_cache:
+        main.agent_cache = main.AgentCache(0, 0)
+        main.shared_flights = None
+    for agent in vars(main.orchestrator).values():
+        if isinstance(agent, main.Agent):
+            agent.use_ai = True
+
+    agent_times: Dict[str, List[float]] = {}
+    instrument_agents(agent_times)
+
+    bodies = build_requests(plans, args.requests, rng)
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    params = {"mode": args.mode} if args.mode else {}
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        async def send(body: dict):
+            async with semaphore:
+                started = time.monotonic()
+                response = await client.post("/api/plan-trip", json=body, params=params)
+                latencies.append(time.monotonic() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(send(body) for body in bodies))
+        elapsed = time.monotonic() - started
+
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "latencyModel": args.latency,
+        "errorRate": args.error_rate,
+        "elapsedSeconds": round(elapsed, 3),
+        "requestsPerSecond": round(args.requests / elapsed, 2) if elapsed else 0.0,
+        "statusCodes": statuses,
+        "latency": summarize(latencies),
+        "compactPrompts": main.COMPACT_PROMPTS,
+        "agents": {role: {**summarize(times), "promptTokens": prompt_tokens_by_agent().get(role, 0.0)}
+                   for role, times in sorted(agent_times.items())},
+        "cache": main.agent_cache.get_stats()["totals"],
+        "coalescing": {"plans": main.plan_flights.get_stats()["callsSaved"],
+                       "agents": main.agent_flights.get_stats()["callsSaved"]},
+    }
+
+def print_report(report: dict):
+    print(f"\n{report['requests']} requests at concurrency {report['concurrency']} "
+          f"(latency {report['latencyModel']}, error rate {report['errorRate']})")
+    print(f"  elapsed: {report['elapsedSeconds']}s   throughput: {report['requestsPerSecond']} req/s")
+    print(f"  status codes: {report['statusCodes']}")
+    latency = report["latency"]
+    print(f"  latency p50 {latency['p50']}s   p95 {latency['p95']}s   p99 {latency['p99']}s   mean {latency['mean']}s")
+    print(f"  cache: {report['cache']}   coalesced: {report['coalescing']}")
+    print(f"\n  per agent ({'compact' if report['compactPrompts'] else 'full'} prompts):")
+    for role, times in report["agents"].items():
+        print(f"    {role:<28} calls {times['count']:>5}   mean {times['mean']:.3f}s   p95 {times['p95']:.3f}s"
+              f"   prompt tokens {times['promptTokens']:.0f}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline throughput and latency benchmark for /api/plan-trip")
+    parser.add_argument("--requests", type=int, default=100, help="total plan requests to send")
+    parser.add_argument("--concurrency", type=int, default=10, help="requests in flight at once")
+    parser.add_argument("--latency", default="lognormal:-0.5,0.5",
+                        help="simulated model latency: fixed:S, uniform:A,B, normal:MU,SD or lognormal:MU,SIGMA")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of model calls that fail")
+    parser.add_argument("--rate-per-minute", type=float, default=0,
+                        help="model call token bucket rate, as GEMINI_RATE_PER_MINUTE (default 0, unlimited)")
+    parser.add_argument("--prompt-latency", type=float, default=0.0,
+                        help="extra simulated latency in seconds per 1000 prompt tokens")
+    parser.add_argument("--full-prompts", action="store_true",
+                        help="embed upstream results whole (COMPACT_PROMPTS=false) to compare prompt cost")
+    parser.add_argument("--mode", choices=main.EXECUTION_MODES, help="execution mode (default PLAN_EXECUTION_MODE)")
+    parser.add_argument("--no-cache", action="store_true", help="disable the agent result cache")
+    parser.add_argument("--seed", type=int, default=7, help="random seed for requests, latency and errors")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    # Keep the plans the API saves out of the real logs directory
+    os.chdir(tempfile.mkdtemp(prefix="travel-planner-bench-"))
+    report = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
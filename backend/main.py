@@ -1,26 +1,67 @@
 # Multi-Agent Travel Planner Backend with Google Gemini - FIXED VERSION
 # Install: pip install fastapi uvicorn google-generativeai pydantic python-dotenv
 
-from fastapi import FastAPI, HTTPException
+# Taken first so the import phase of startup covers the framework imports too
+import time
+IMPORT_STARTED = time.monotonic()
+
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from collections import Counter as Tally, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import copy
+import glob
+import hashlib
+import heapq
+import importlib.util
+import itertools
+import math
 import os
 import json
-from datetime import datetime
+import queue
+import random
+import re
+import socket
+import sqlite3
+import threading
+import unicodedata
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 load_dotenv()  # Add this line!
-import google.generativeai as genai
-# Import Google Generative AI
+# Google Generative AI is only imported when the model client is built (see load_genai);
+# importing it takes about half a second
 try:
-    import google.generativeai as genai
-    GEMINI_AVAILABLE = True
+    GEMINI_AVAILABLE = importlib.util.find_spec("google.generativeai") is not None
 except ImportError:
     GEMINI_AVAILABLE = False
+if not GEMINI_AVAILABLE:
     print("WARNING: google.generativeai not installed")
+genai = None
+
+try:
+    from google.api_core import exceptions as google_exceptions
+    GOOGLE_API_ERRORS_AVAILABLE = True
+except ImportError:
+    GOOGLE_API_ERRORS_AVAILABLE = False
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build clients, stores and agents when a worker starts rather than on import"""
+    await start_services()
+    yield
+    await stop_services()
 
 # Initialize FastAPI
-app = FastAPI(title="AI Travel Planner API")
+app = FastAPI(title="AI Travel Planner API", lifespan=lifespan)
 # timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 # filename = f"logs/travel_plan_{timestamp}.json"
 
@@ -35,9 +76,135 @@ app.add_middleware(
 
 # Configure Google Gemini
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
-print("gemini zpi key :", GEMINI_API_KEY)
-if GEMINI_AVAILABLE and GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+
+def load_genai():
+    """Import and configure the Gemini SDK once, on first use"""
+    global genai
+    if genai is None and GEMINI_AVAILABLE:
+        import google.generativeai as sdk
+        if GEMINI_API_KEY:
+            sdk.configure(api_key=GEMINI_API_KEY)
+        genai = sdk
+    return genai
+
+# Upper bound on Gemini calls in flight at once across all requests in this worker
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+
+# Model names tried, in order, when a requested model does not answer the startup probe
+GEMINI_MODEL_CANDIDATES = [m.strip() for m in os.getenv(
+    "GEMINI_MODEL_CANDIDATES", "gemini-2.5-flash,gemini-1.5-flash,gemini-1.5-pro,gemini-pro"
+).split(",") if m.strip()]
+
+# Seconds each candidate gets to answer the probe, and how long a model no candidate answered
+# for fails fast before it is probed again
+GEMINI_PROBE_TIMEOUT_SECONDS = float(os.getenv("GEMINI_PROBE_TIMEOUT_SECONDS", "10"))
+GEMINI_PROBE_RETRY_SECONDS = float(os.getenv("GEMINI_PROBE_RETRY_SECONDS", "60"))
+
+# Retries for transient Gemini errors, and circuit breaker that fails fast after repeated failures
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "2"))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "0.5"))
+GEMINI_CIRCUIT_THRESHOLD = int(os.getenv("GEMINI_CIRCUIT_THRESHOLD", "5"))
+GEMINI_CIRCUIT_RESET_SECONDS = float(os.getenv("GEMINI_CIRCUIT_RESET_SECONDS", "30"))
+
+# Model and generation settings per agent role. AGENT_ROUTES is a JSON object mapping a role
+# (e.g. "Local Expert") to any of "model", "temperature", "maxOutputTokens" and "timeout"
+# (seconds); it is layered over the built-in routes below, and unset fields keep the defaults
+DEFAULT_AGENT_MODEL = os.getenv("DEFAULT_AGENT_MODEL", "gemini-2.5-flash")
+AGENT_ROUTE_DEFAULTS = {
+    # Short generic tips do not need the full model
+    "Local Expert": {"model": "gemini-2.5-flash-lite", "maxOutputTokens": 1024},
+}
+AGENT_ROUTES = json.loads(os.getenv("AGENT_ROUTES", "{}"))
+
+# Upstream results are cut down to the fields a downstream prompt uses, within this many
+# estimated tokens per list (COMPACT_PROMPTS=false embeds them whole, as before)
+COMPACT_PROMPTS = os.getenv("COMPACT_PROMPTS", "true").lower() in ("1", "true", "yes")
+PROMPT_INPUT_TOKEN_BUDGET = int(os.getenv("PROMPT_INPUT_TOKEN_BUDGET", "400"))
+
+# Token bucket sized to the project's Gemini quota (0 disables it), the bounded queue of calls
+# waiting for a token or a concurrency slot, and the queue depth at which new interactive
+# plan requests are turned away with 429 instead of piling up
+GEMINI_RATE_PER_MINUTE = float(os.getenv("GEMINI_RATE_PER_MINUTE", "300"))
+GEMINI_RATE_BURST = int(os.getenv("GEMINI_RATE_BURST", "30"))
+MODEL_QUEUE_SIZE = int(os.getenv("MODEL_QUEUE_SIZE", "500"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "100"))
+
+# Near-duplicate matching for cache and coalescing keys: minimum trigram similarity for two
+# destinations, minimum overlap for two interest sets (1 only folds synonyms, since at 0.75 a
+# fourth interest added to three would be ignored), and how many destinations, interest sets
+# and requests are remembered for matching (least recent go first). Dates are always exact
+DESTINATION_MATCH_THRESHOLD = float(os.getenv("DESTINATION_MATCH_THRESHOLD", "0.85"))
+INTEREST_MATCH_THRESHOLD = float(os.getenv("INTEREST_MATCH_THRESHOLD", "1.0"))
+MATCH_MAX_DESTINATIONS = int(os.getenv("MATCH_MAX_DESTINATIONS", "4096"))
+MATCH_MAX_INTEREST_SETS = int(os.getenv("MATCH_MAX_INTEREST_SETS", "256"))
+MATCH_MAX_REQUESTS = int(os.getenv("MATCH_MAX_REQUESTS", "4096"))
+
+# Agent result cache: in-memory LRU size, entry lifetime, and SQLite file that survives restarts
+# and is shared by every worker process on the host (empty keeps the cache in memory only)
+AGENT_CACHE_SIZE = int(os.getenv("AGENT_CACHE_SIZE", "1024"))
+AGENT_CACHE_TTL = float(os.getenv("AGENT_CACHE_TTL", str(24 * 60 * 60)))
+AGENT_CACHE_DB = os.getenv("AGENT_CACHE_DB", "logs/agent_cache.db")
+
+# Cross-process coalescing of agent calls through the cache file: how long a worker's claim on
+# a call lasts before others give up waiting for it, and how often waiting workers look for its result
+SHARED_FLIGHT_LEASE_SECONDS = float(os.getenv("SHARED_FLIGHT_LEASE_SECONDS", "60"))
+SHARED_FLIGHT_POLL_SECONDS = float(os.getenv("SHARED_FLIGHT_POLL_SECONDS", "0.1"))
+
+# "split" sends one prompt per agent; "fused" combines the independent agents into one prompt
+PLAN_EXECUTION_MODE = os.getenv("PLAN_EXECUTION_MODE", "split")
+EXECUTION_MODES = ("split", "fused")
+
+# Distinct trips planned at the same time within one batch request
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+
+# Longer trips get their itinerary generated in parallel chunks of this many days; chunks are
+# widened beyond that so no trip needs more than ITINERARY_MAX_CHUNKS model calls
+ITINERARY_CHUNK_DAYS = int(os.getenv("ITINERARY_CHUNK_DAYS", "7"))
+ITINERARY_MAX_CHUNKS = max(1, int(os.getenv("ITINERARY_MAX_CHUNKS", "8")))
+
+# End-to-end deadline for building a plan (0 disables it), split between the steps by their
+# position on the critical path; a step that overruns its share falls back. Queued jobs and
+# batch trips wait behind interactive calls with no client watching each plan, so they get a
+# looser deadline, counted from when the trip starts running
+PLAN_DEADLINE_SECONDS = float(os.getenv("PLAN_DEADLINE_SECONDS", "12"))
+JOB_DEADLINE_SECONDS = float(os.getenv("JOB_DEADLINE_SECONDS", "120"))
+BATCH_DEADLINE_SECONDS = float(os.getenv("BATCH_DEADLINE_SECONDS", "120"))
+
+# Recent plans kept in memory with their agent results so they can be re-planned quickly
+PLAN_HISTORY_SIZE = int(os.getenv("PLAN_HISTORY_SIZE", "500"))
+
+# Background pre-generation of destination-level agent results for popular trips: off-peak
+# local hours ("start-end"), run interval, model-call budget per run, how many trips to keep
+# warm, how far back to look for popularity, and how close to expiry a result is refreshed
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() in ("1", "true", "yes")
+PREFETCH_HOURS = tuple(int(h) for h in os.getenv("PREFETCH_HOURS", "1-6").split("-"))
+PREFETCH_INTERVAL_SECONDS = float(os.getenv("PREFETCH_INTERVAL_SECONDS", "1800"))
+PREFETCH_MAX_CALLS = int(os.getenv("PREFETCH_MAX_CALLS", "60"))
+PREFETCH_TOP_TRIPS = int(os.getenv("PREFETCH_TOP_TRIPS", "20"))
+PREFETCH_HISTORY_DAYS = float(os.getenv("PREFETCH_HISTORY_DAYS", "14"))
+PREFETCH_REFRESH_BEFORE = float(os.getenv("PREFETCH_REFRESH_BEFORE", str(6 * 60 * 60)))
+
+# Plan store: SQLite file, write batching, and retention by age (days) and count (0 keeps everything)
+PLAN_STORE_DB = os.getenv("PLAN_STORE_DB", "logs/plans.db")
+PLAN_STORE_BATCH_SIZE = int(os.getenv("PLAN_STORE_BATCH_SIZE", "50"))
+PLAN_STORE_FLUSH_SECONDS = float(os.getenv("PLAN_STORE_FLUSH_SECONDS", "1.0"))
+PLAN_STORE_RETENTION_DAYS = float(os.getenv("PLAN_STORE_RETENTION_DAYS", "90"))
+PLAN_STORE_MAX_PLANS = int(os.getenv("PLAN_STORE_MAX_PLANS", "100000"))
+
+# Response compression: gzip bodies of at least this many bytes (0 disables it) at this level;
+# event streams are never compressed so their events are not held back
+RESPONSE_GZIP_MIN_BYTES = int(os.getenv("RESPONSE_GZIP_MIN_BYTES", "1024"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
+
+# Plan jobs: SQLite queue shared by every worker process, worker tasks per process (0 only
+# enqueues), idle poll interval, how long a running job's lease lasts before another worker
+# may take it over, attempts per job, and days finished jobs are kept
+JOB_QUEUE_DB = os.getenv("JOB_QUEUE_DB", "logs/jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1.0"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", "7"))
 
 # Models
 class TravelRequest(BaseModel):
@@ -48,67 +215,1767 @@ class TravelRequest(BaseModel):
     budget: Optional[str] = None
     interests: List[str] = []
 
-class Agent:
-    """Base Agent class for multi-agent system - FIXED VERSION"""
-    def __init__(self, role: str, model_name: str = "gemini-2.5-flash"):
-        self.role = role
-        self.model_name = model_name
-        self.use_ai = GEMINI_AVAILABLE and GEMINI_API_KEY
+class TravelRequestUpdate(BaseModel):
+    """Fields to change on a previous plan's request; omitted fields keep their value, and
+    an explicit null clears budget"""
+    destination: Optional[str] = None
+    startDate: Optional[str] = None
+    endDate: Optional[str] = None
+    travelers: Optional[int] = None
+    budget: Optional[str] = None
+    interests: Optional[List[str]] = None
+
+class BatchTravelRequest(BaseModel):
+    requests: List[TravelRequest]
+    stream: bool = False
+
+# Metrics and tracing
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+metrics_registry: List["Metric"] = []
+
+def format_labels(labels: Dict[str, object]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Metric:
+    """A labelled metric rendered in the Prometheus text exposition format"""
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[str, ...], object] = {}
+        metrics_registry.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self._samples(dict(zip(self.label_names, key)), value))
+        return lines
+
+    def _samples(self, labels: Dict[str, object], value) -> List[str]:
+        return [f"{self.name}{format_labels(labels)} {value}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [bucket + (value <= bound) for bucket, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def _samples(self, labels: Dict[str, object], value) -> List[str]:
+        counts, total, count = value
+        lines = [f"{self.name}_bucket{format_labels({**labels, 'le': bound})} {bucket}"
+                 for bound, bucket in zip(self.buckets, counts)]
+        lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': '+Inf'})} {count}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+AGENT_CALL_SECONDS = Histogram(
+    "agent_model_call_seconds", "Wall time of an agent's model call, including retries", ("agent",))
+AGENT_QUEUE_SECONDS = Histogram(
+    "agent_model_queue_seconds", "Time an agent's model call waited for a rate-limit token and concurrency slot",
+    ("agent", "priority"))
+AGENT_PROMPT_TOKENS = Histogram(
+    "agent_prompt_tokens", "Estimated prompt tokens per model call", ("agent",), TOKEN_BUCKETS)
+AGENT_RESPONSE_TOKENS = Histogram(
+    "agent_response_tokens", "Estimated response tokens per model call", ("agent",), TOKEN_BUCKETS)
+AGENT_RESULTS = Counter(
+    "agent_results_total", "Agent results by outcome: cache_hit, parsed, salvaged, fallback or timeout",
+    ("agent", "outcome"))
+AGENT_RETRIES = Counter(
+    "agent_model_retries_total", "Model calls retried after a transient error", ("agent",))
+AGENT_ERRORS = Counter(
+    "agent_model_errors_total", "Model calls that failed after retries", ("agent", "error"))
+STEP_SECONDS = Histogram(
+    "orchestrator_step_seconds", "Wall time of each orchestrator step, including cache hits", ("step",))
+PLAN_SECONDS = Histogram(
+    "plan_seconds", "Wall time to build a complete plan", ("mode",))
+HTTP_SECONDS = Histogram(
+    "http_request_seconds", "HTTP request handling time", ("method", "path", "status"))
+CACHE_EVENTS = Gauge(
+    "agent_cache_events", "Agent cache hits, disk hits, misses and evictions since start", ("agent", "event"))
+COALESCED_CALLS = Gauge(
+    "coalesced_calls", "Calls that shared an in-flight computation since start", ("kind", "namespace"))
+STARTUP_SECONDS = Gauge(
+    "startup_seconds", "Time this worker spent in each startup phase: import, init, probe and ready", ("phase",))
+MODEL_QUEUE_DEPTH = Gauge(
+    "model_queue_depth", "Model calls waiting for a rate-limit token or concurrency slot", ("priority",))
+MODEL_IN_FLIGHT = Gauge(
+    "model_calls_in_flight", "Model calls currently running")
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total", "Plan requests turned away before any work: overloaded or circuit_open", ("reason",))
+
+# Spans of the request being traced, if any; tasks spawned for the request inherit it
+current_trace: ContextVar[Optional[dict]] = ContextVar("current_trace", default=None)
+
+@contextmanager
+def trace_span(name: str, **attributes):
+    """Record a span on the current request's trace, when it is being traced"""
+    trace = current_trace.get()
+    started = time.monotonic()
+    try:
+        yield attributes
+    finally:
+        if trace is not None:
+            trace["spans"].append({
+                "name": name,
+                "startMs": round((started - trace["started"]) * 1000, 1),
+                "durationMs": round((time.monotonic() - started) * 1000, 1),
+                **attributes,
+            })
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gemini while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Stops calling a failing upstream until a cool-down has passed.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls fail
+    fast; once `reset_seconds` have elapsed a single trial call is let through.
+    """
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+class QueueFullError(Exception):
+    """Raised instead of queueing a model call when the scheduler queue is full"""
+
+# Model-call priorities, most urgent first; batch and prefetch work set theirs on entry
+PRIORITIES = {"interactive": 0, "batch": 1, "prefetch": 2}
+current_priority: ContextVar[str] = ContextVar("current_priority", default="interactive")
+
+# Tickets of the coalesced computations this code runs inside, outermost first. A ticket holds
+# the priority its callers need and the model calls it is queued on, so a more urgent caller
+# joining the computation can promote them
+current_flights: ContextVar[Tuple[dict, ...]] = ContextVar("current_flights", default=())
+
+def effective_priority() -> str:
+    """The most urgent of this context's priority and those of the computations it serves"""
+    names = [current_priority.get()] + [ticket["priority"] for ticket in current_flights.get()]
+    return min(names, key=PRIORITIES.__getitem__)
+
+class ModelScheduler:
+    """Grants model calls a rate-limit token and a concurrency slot, most urgent first.
+
+    Tokens refill at `rate_per_minute` up to `burst`; at most `max_concurrency` calls
+    run at once. Waiting calls are kept in a priority queue bounded by `max_queue`, so
+    interactive requests overtake batch and prefetch work; `promote` moves queued
+    calls up when a more urgent caller comes to depend on them. Runs on the event
+    loop thread only.
+    """
+    def __init__(self, rate_per_minute: float, burst: int, max_concurrency: int, max_queue: int):
+        self.rate = rate_per_minute / 60
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.refilled = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting: List[List] = []
+        self.sequence = itertools.count()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.stats = {"granted": 0, "rejected": 0, "throttled": 0, "promoted": 0}
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def _dispatch(self):
+        self._refill()
+        while self.waiting and self.in_flight < self.max_concurrency:
+            future = self.waiting[0][2]
+            if future.done():
+                # Caller was cancelled while waiting
+                heapq.heappop(self.waiting)
+                continue
+            if self.rate > 0 and self.tokens < 1:
+                if self.timer is None:
+                    self.stats["throttled"] += 1
+                    delay = (1 - self.tokens) / self.rate
+                    self.timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+                break
+            heapq.heappop(self.waiting)
+            if self.rate > 0:
+                self.tokens -= 1
+            self.in_flight += 1
+            self.stats["granted"] += 1
+            future.set_result(None)
+
+    def _on_timer(self):
+        self.timer = None
+        self._dispatch()
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: str, role: str, tickets: Tuple[dict, ...] = ()):
+        """Wait for a token and a concurrency slot; raises QueueFullError when the queue is full.
+
+        While it waits, the call is listed on each of `tickets` so it can be promoted.
+        """
+        if len(self.waiting) >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise QueueFullError("Model call queue is full")
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, [PRIORITIES[priority], next(self.sequence), future])
+        for ticket in tickets:
+            ticket["waiting"].add(future)
+        queued = time.monotonic()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as the caller was cancelled
+                self.release()
+            raise
+        finally:
+            for ticket in tickets:
+                ticket["waiting"].discard(future)
+        AGENT_QUEUE_SECONDS.observe(time.monotonic() - queued, agent=role, priority=priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def promote(self, futures: set, priority: str):
+        """Raise the queued calls waiting on `futures` to at least `priority`"""
+        rank = PRIORITIES[priority]
+        changed = False
+        for entry in self.waiting:
+            if entry[2] in futures and entry[0] > rank:
+                entry[0] = rank
+                changed = True
+        if changed:
+            heapq.heapify(self.waiting)
+            self.stats["promoted"] += 1
+
+    def depth(self, priority: Optional[str] = None) -> int:
+        """Calls waiting, optionally only those at `priority`"""
+        rank = PRIORITIES.get(priority)
+        return sum(1 for p, _, future in self.waiting
+                   if not future.done() and (rank is None or p == rank))
+
+    def retry_after(self, priority: Optional[str] = None) -> int:
+        """Seconds until the calls queued at `priority` or more urgently should have drained,
+        for Retry-After; all queued calls without one"""
+        if self.rate <= 0:
+            return 1
+        if priority is None:
+            waiting = self.depth()
+        else:
+            waiting = sum(self.depth(name) for name, rank in PRIORITIES.items() if rank <= PRIORITIES[priority])
+        return max(1, math.ceil((waiting - self.tokens) / self.rate))
+
+    def get_stats(self) -> dict:
+        self._refill()
+        return {
+            **self.stats,
+            "ratePerMinute": self.rate * 60,
+            "tokens": round(self.tokens, 2),
+            "inFlight": self.in_flight,
+            "maxConcurrency": self.max_concurrency,
+            "queued": {name: self.depth(name) for name in PRIORITIES},
+            "maxQueue": self.max_queue,
+        }
 
-    def generate(self, prompt: str) -> str:
-        """Generate response from Gemini with fallback"""
-        if not self.use_ai:
-            print(f"{self.role}: Using fallback (AI not configured)")
-            return "{}"
+class ModelRoute:
+    """The model and generation settings one agent role is served with"""
+    def __init__(self, model: str, temperature: Optional[float] = None, max_output_tokens: Optional[int] = None,
+                 timeout: Optional[float] = None):
+        self.model = model
+        self.temperature = temperature
+        self.max_output_tokens = max_output_tokens
+        self.timeout = timeout
+
+    @classmethod
+    def for_role(cls, role: str, model: str = DEFAULT_AGENT_MODEL) -> "ModelRoute":
+        settings = {**AGENT_ROUTE_DEFAULTS.get(role, {}), **AGENT_ROUTES.get(role, {})}
+        return cls(settings.get("model", model), settings.get("temperature"),
+                   settings.get("maxOutputTokens"), settings.get("timeout"))
+
+    def generation_config(self) -> Optional[dict]:
+        config = {}
+        if self.temperature is not None:
+            config["temperature"] = self.temperature
+        if self.max_output_tokens is not None:
+            config["max_output_tokens"] = self.max_output_tokens
+        return config or None
+
+    def to_dict(self) -> dict:
+        return {"model": self.model, "temperature": self.temperature,
+                "maxOutputTokens": self.max_output_tokens, "timeout": self.timeout}
+
+# Called with each chunk of a streamed model response
+TextCallback = Callable[[str], Awaitable[None]]
+
+class ModelClient:
+    """Shared Gemini client registry used by every agent.
+
+    The SDK's API style is detected once, and each requested model name is resolved
+    to a working one on first use (or at startup via `probe`); a model that could not
+    be resolved fails fast for GEMINI_PROBE_RETRY_SECONDS. Model objects are
+    reused across agents and requests. Every call, retries included, waits on the
+    ModelScheduler for a rate-limit token and a concurrency slot at the current
+    request's priority. Calls are non-blocking: the native async API
+    is used when available, otherwise the blocking call runs on a dedicated
+    executor. Transient errors are retried with jittered backoff, and a circuit
+    breaker makes a degraded upstream fail fast so agents drop to their fallbacks.
+    """
+    def __init__(self, max_concurrency: int = GEMINI_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.scheduler = ModelScheduler(GEMINI_RATE_PER_MINUTE, GEMINI_RATE_BURST, max_concurrency, MODEL_QUEUE_SIZE)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="gemini")
+        self.breaker = CircuitBreaker(GEMINI_CIRCUIT_THRESHOLD, GEMINI_CIRCUIT_RESET_SECONDS)
+        self.method = self._detect_method()
+        self.resolved: Dict[str, str] = {}
+        # Model name -> (monotonic time of the failed probe, its error)
+        self.unresolved: Dict[str, Tuple[float, str]] = {}
+        self.models: Dict[str, object] = {}
+        self.probe_lock = asyncio.Lock()
+
+    def _detect_method(self) -> Optional[str]:
+        if load_genai() is None:
+            return None
+        if hasattr(genai, "GenerativeModel"):
+            if hasattr(genai.GenerativeModel, "generate_content_async"):
+                return "generate_content_async"
+            return "generate_content"
+        if hasattr(genai, "generate_text"):
+            return "generate_text"
+        return None
+
+    def _model(self, model_name: str):
+        if model_name not in self.models:
+            self.models[model_name] = genai.GenerativeModel(model_name)
+        return self.models[model_name]
+
+    async def _call(self, model_name: str, prompt: str, on_text: Optional[TextCallback] = None,
+                    generation_config: Optional[dict] = None) -> str:
+        if self.method == "generate_content_async":
+            model = self._model(model_name)
+            if on_text is None:
+                response = await model.generate_content_async(prompt, generation_config=generation_config)
+                return response.text
+            parts = []
+            async for chunk in await model.generate_content_async(
+                    prompt, generation_config=generation_config, stream=True):
+                parts.append(chunk.text)
+                await on_text(chunk.text)
+            return "".join(parts)
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(self.executor, self._call_sync, model_name, prompt, generation_config)
+        if on_text is not None:
+            await on_text(text)
+        return text
+
+    def _call_sync(self, model_name: str, prompt: str, generation_config: Optional[dict] = None) -> str:
+        generation_config = generation_config or {}
+        if self.method == "generate_content":
+            return self._model(model_name).generate_content(prompt, generation_config=generation_config).text
+        response = genai.generate_text(
+            model=f"models/{model_name}",
+            prompt=prompt,
+            temperature=generation_config.get("temperature", 0.7),
+            max_output_tokens=generation_config.get("max_output_tokens", 2048)
+        )
+        return response.result if hasattr(response, 'result') else response.text
+
+    async def probe(self, model_name: str) -> str:
+        """Resolve `model_name` to the first candidate that answers, once"""
+        self._check_unresolved(model_name)
+        async with self.probe_lock:
+            if model_name in self.resolved:
+                return self.resolved[model_name]
+            # Another caller may have failed this probe while we waited for the lock
+            self._check_unresolved(model_name)
+            if self.method is None:
+                raise RuntimeError("No supported google.generativeai API found")
+
+            candidates = [model_name] + [m for m in GEMINI_MODEL_CANDIDATES if m != model_name]
+            errors = []
+            for candidate in candidates:
+                try:
+                    await asyncio.wait_for(self._call(candidate, "Say hi in one word"), GEMINI_PROBE_TIMEOUT_SECONDS)
+                    print(f"Model client: '{model_name}' -> '{candidate}' via {self.method}")
+                    self.resolved[model_name] = candidate
+                    self.unresolved.pop(model_name, None)
+                    return candidate
+                except asyncio.TimeoutError:
+                    errors.append(f"{candidate}: no answer in {GEMINI_PROBE_TIMEOUT_SECONDS:g}s")
+                except Exception as e:
+                    errors.append(f"{candidate}: {str(e)[:120]}")
+            message = "No working Gemini model: " + "; ".join(errors)
+            self.unresolved[model_name] = (time.monotonic(), message)
+            raise RuntimeError(message)
+
+    def _check_unresolved(self, model_name: str):
+        failed = self.unresolved.get(model_name)
+        if failed is not None and time.monotonic() - failed[0] < GEMINI_PROBE_RETRY_SECONDS:
+            raise RuntimeError(failed[1])
+
+    async def generate(self, model_name: str, prompt: str, role: str = "unknown",
+                       on_text: Optional[TextCallback] = None, generation_config: Optional[dict] = None) -> str:
+        """The model's response; with `on_text`, it is streamed and each chunk passed on as it arrives.
+
+        `generation_config` holds per-call settings such as temperature and max_output_tokens.
+        """
+        # Only the call that takes the half-open trial may hand it back
+        trial = self.breaker.state == "half-open"
+        if not self.breaker.allow():
+            raise CircuitOpenError("Gemini circuit open, failing fast")
+
+        streamed = False
+
+        async def relay(chunk: str):
+            nonlocal streamed
+            streamed = True
+            await on_text(chunk)
 
         try:
-            # Try multiple API methods based on version
+            for attempt in range(GEMINI_MAX_RETRIES + 1):
+                try:
+                    # Resolved before taking a slot, so a slow probe does not hold one
+                    resolved = self.resolved.get(model_name) or await self.probe(model_name)
+                    async with self.scheduler.slot(effective_priority(), role, current_flights.get()):
+                        text = await self._call(resolved, prompt, relay if on_text else None, generation_config)
+                    self.breaker.record_success()
+                    return text
+                except QueueFullError:
+                    # Load shedding, not an upstream failure
+                    raise
+                except Exception as e:
+                    # Chunks already passed on cannot be taken back, so those calls are not retried
+                    if attempt == GEMINI_MAX_RETRIES or not is_retryable(e) or streamed:
+                        self.breaker.record_failure()
+                        raise
+                    AGENT_RETRIES.inc(agent=role)
+                    # Full jitter keeps concurrent retries from stampeding together
+                    await asyncio.sleep(random.uniform(0, GEMINI_RETRY_BASE_DELAY * 2 ** attempt))
+        except (asyncio.CancelledError, QueueFullError):
+            # Neither says anything about the upstream; let the next call make the trial
+            if trial:
+                self.breaker.trial_in_flight = False
+            raise
+
+    def get_status(self) -> dict:
+        return {
+            "method": self.method,
+            "models": dict(self.resolved),
+            "circuit": self.breaker.state,
+            "consecutiveFailures": self.breaker.failures,
+            "scheduler": self.scheduler.get_stats(),
+        }
 
-            # Method 1: Try GenerativeModel (newer API)
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (CircuitOpenError, QueueFullError, NotImplementedError)):
+        return False
+    if GOOGLE_API_ERRORS_AVAILABLE:
+        return isinstance(error, (
+            google_exceptions.TooManyRequests,
+            google_exceptions.ResourceExhausted,
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.InternalServerError,
+            google_exceptions.DeadlineExceeded,
+        ))
+    return True
+
+# Built by initialize() when a worker starts
+model_client: Optional[ModelClient] = None
+
+# Strings (group 1 is unset while one is still open), punctuation, and bare scalar runs
+# such as numbers, true, false and null
+JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*(")?|[{}\[\],:]|[^\s{}\[\],:"]+', re.S)
+JSON_OPENER = re.compile(r"[\[{]")
+JSON_SCALAR = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null")
+CLOSERS = {"{": "}", "[": "]"}
+
+class JsonStreamParser:
+    """Incremental, forgiving reader for the JSON in model output.
+
+    Text can be fed as it streams in. Anything before the value (prose, code
+    fences) and after it closes is ignored, trailing commas are dropped, and raw
+    control characters inside strings (a literal tab, say) are accepted. A
+    bracketed value that closes but holds bare words, such as "[see below]" in
+    prose, is skipped and reading starts again at the next bracket; any other
+    value that closes but is not JSON makes `result` raise. `feed` returns the
+    elements of the top-level array, or of arrays held directly by top-level
+    keys, as each one closes. `result` returns the whole value; if the text stops
+    early it is cut back to the last complete value (or array element) and
+    closed, and `truncated` is set.
+    """
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.scan_from = 0
+        self.start: Optional[int] = None
+        self.end: Optional[int] = None
+        self.value = None
+        self.error: Optional[str] = None
+        # Whether the value being read holds bare words, i.e. is really bracketed prose
+        self.prose = False
+        # Open containers: bracket, whether an object awaits a key, the key it sits under,
+        # and where the array element being read began
+        self.stack: List[dict] = []
+        self.last = ""
+        self.last_end = 0
+        self.last_comma = 0
+        self.drops: List[int] = []
+        self.safe: Optional[Tuple[int, str]] = None
+        self.truncated = False
+
+    def feed(self, chunk: str) -> List[Tuple[Optional[str], object]]:
+        self.text += chunk
+        items = []
+        while self.end is None:
+            if self.start is None:
+                found = JSON_OPENER.search(self.text, self.scan_from)
+                if found is None:
+                    break
+                self.start = self.pos = found.start()
+            match = JSON_TOKEN.search(self.text, self.pos)
+            if match is None:
+                break
+            token = match.group()
+            if token[0] == '"' and match.group(1) is None:
+                # String still streaming in; read it again once more text arrives
+                break
+            if token[0] not in '"{}[],:' and match.end() == len(self.text):
+                # A number or literal may continue in the next chunk
+                break
+            self._token(token, match.start(), match.end(), items)
+            self.pos = match.end()
+            if self.end is not None:
+                self._finish()
+        return items
+
+    def _finish(self):
+        """Parse the value that just closed, or skip past its opening bracket if it is prose"""
+        try:
+            self.value = json.loads(self._segment(self.start, self.end), strict=False)
+        except ValueError as e:
+            if not self.prose:
+                self.error = f"Invalid JSON value in response: {e}"
+                return
+            self.prose = False
+            self.scan_from = self.start + 1
+            self.start = self.end = None
+            self.stack = []
+            self.last = ""
+            self.drops = []
+            self.safe = None
+
+    def _token(self, token: str, index: int, end: int, items: list):
+        frame = self.stack[-1] if self.stack else None
+        if token in CLOSERS:
+            if frame is not None and frame["bracket"] == "[" and frame["item"] is None:
+                frame["item"] = index
+            key = None
+            if frame is not None and frame["bracket"] == "{":
+                key = frame["key"]
+            self.stack.append({"bracket": token, "expectKey": token == "{", "key": key, "item": None,
+                               "items": frame is None or (len(self.stack) == 1 and frame["bracket"] == "{")})
+            self._mark_safe(end)
+        elif token in ("}", "]"):
+            if self.last == ",":
+                self.drops.append(self.last_comma)
+            closed = self.stack.pop() if self.stack else None
+            if closed is None:
+                return
+            if not self.stack:
+                self.end = end
+            else:
+                self._element_done(end, items)
+                self._mark_safe(end)
+        elif token == ",":
+            if frame is not None and (self.last in ("}", "]", "value") or self.text[self.last_end:index].strip()):
+                self._mark_safe(index)
+                if frame["bracket"] == "[":
+                    frame["item"] = None
+                else:
+                    frame["expectKey"] = True
+            self.last_comma = index
+        elif token == ":":
+            if frame is not None:
+                frame["expectKey"] = False
+        elif frame is not None:
+            if frame["bracket"] == "{" and frame["expectKey"] and token[0] == '"':
+                try:
+                    frame["key"] = json.loads(token, strict=False)
+                except ValueError:
+                    # A malformed escape; the raw name is close enough to route elements
+                    frame["key"] = token[1:-1]
+                token = "key"
+            else:
+                if token[0] != '"' and (frame["bracket"] == "{" and frame["expectKey"]
+                                        or not JSON_SCALAR.fullmatch(token)):
+                    self.prose = True
+                if frame["bracket"] == "[" and frame["item"] is None:
+                    frame["item"] = index
+                    self._element_done(end, items)
+                self._mark_safe(end)
+                token = "value"
+        self.last = token
+        self.last_end = end
+
+    def _element_done(self, end: int, items: list):
+        """Emit the element that just closed, if its array is one whose items are streamed"""
+        frame = self.stack[-1]
+        if frame["bracket"] == "[" and frame["items"] and frame["item"] is not None:
             try:
-                model = genai.GenerativeModel(self.model_name)
-                response = model.generate_content(prompt)
-                return response.text
-            except AttributeError:
+                items.append((frame["key"], json.loads(self._segment(frame["item"], end), strict=False)))
+            except ValueError:
                 pass
+            frame["item"] = None
+
+    def _mark_safe(self, index: int):
+        # Half an attraction or itinerary day is worth less than none
+        if any(frame["items"] and frame["item"] is not None for frame in self.stack):
+            return
+        self.safe = (index, "".join(CLOSERS[frame["bracket"]] for frame in reversed(self.stack)))
+
+    def _segment(self, start: int, end: int) -> str:
+        pieces, cursor = [], start
+        for drop in self.drops:
+            if start <= drop < end:
+                pieces.append(self.text[cursor:drop])
+                cursor = drop + 1
+        pieces.append(self.text[cursor:end])
+        return "".join(pieces)
+
+    def result(self):
+        if self.start is None:
+            raise ValueError("No JSON value in response")
+        if self.end is not None:
+            if self.error is not None:
+                raise ValueError(self.error)
+            return self.value
+        if self.safe is None:
+            raise ValueError("Response ends before any complete value")
+        self.truncated = True
+        cut, closers = self.safe
+        data = json.loads(self._segment(self.start, cut) + closers, strict=False)
+        if not data:
+            raise ValueError("Response ends before any complete value")
+        return data
+
+# Set by an agent while it parses a response, so it can tell when the result was salvaged
+current_parse: ContextVar[Optional[dict]] = ContextVar("current_parse", default=None)
+
+def load_json_response(response: str):
+    """Parse a model response, repairing fences, prose, trailing commas and truncation"""
+    try:
+        return json.loads(response.replace('```json', '').replace('```', '').strip())
+    except ValueError:
+        pass
+    parser = JsonStreamParser()
+    parser.feed(response)
+    data = parser.result()
+    report = current_parse.get()
+    if report is not None and parser.truncated:
+        report["truncated"] = True
+    return data
+
+def calculate_days(start: str, end: str, default: int = 3) -> int:
+    try:
+        start_date = datetime.strptime(start, "%Y-%m-%d")
+        end_date = datetime.strptime(end, "%Y-%m-%d")
+        return (end_date - start_date).days
+    except:
+        return default
+
+def normalize_request(request: TravelRequest) -> dict:
+    """Canonical form of every request field an agent prompt can depend on"""
+    return {
+        "destination": " ".join(request.destination.lower().split()),
+        "startDate": request.startDate.strip(),
+        "endDate": request.endDate.strip(),
+        "duration": calculate_days(request.startDate, request.endDate),
+        "travelers": request.travelers,
+        "budget": (request.budget or "").strip(),
+        "interests": sorted({i.strip().lower() for i in request.interests if i.strip()}),
+    }
+
+# Common alternative names for destinations, applied before fuzzy matching
+DESTINATION_ALIASES = {
+    "nyc": "new york",
+    "new york city": "new york",
+    "ny": "new york",
+    "la": "los angeles",
+    "sf": "san francisco",
+    "bombay": "mumbai",
+    "new delhi": "delhi",
+    "calcutta": "kolkata",
+    "madras": "chennai",
+    "peking": "beijing",
+}
+
+# Free-text interests folded onto the planner's interest categories
+INTEREST_SYNONYMS = {
+    "foodie": "food", "cuisine": "food", "dining": "food", "restaurants": "food", "street food": "food",
+    "art": "culture", "arts": "culture", "museums": "culture", "museum": "culture", "theatre": "culture",
+    "historical": "history", "heritage": "history", "monuments": "history",
+    "hiking": "adventure", "trekking": "adventure", "sports": "adventure",
+    "outdoors": "nature", "parks": "nature", "wildlife": "nature", "beaches": "relaxation",
+    "beach": "relaxation", "spa": "relaxation", "wellness": "relaxation",
+    "markets": "shopping", "malls": "shopping",
+    "bars": "nightlife", "clubs": "nightlife", "nightclubs": "nightlife",
+}
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class RequestMatcher:
+    """Maps near-duplicate requests onto one canonical form for cache and coalescing keys.
+
+    Destinations are cleaned up (accents, punctuation, aliases) and matched against
+    destinations seen before by character-trigram similarity; a fuzzy match must have
+    the same number of words, so "birmingham al" never folds into "birmingham".
+    Interests are folded onto shared categories and matched to similar interest sets
+    seen before. Dates are left exact: the agents that use them (flights, hotels,
+    the overall plan) answer differently for different dates.
+    Known destinations, interest sets and memoized requests are each kept to a
+    bounded LRU. Everything is computed locally.
+    """
+    def __init__(self, destination_threshold: float, interest_threshold: float,
+                 max_destinations: int = MATCH_MAX_DESTINATIONS, max_interest_sets: int = MATCH_MAX_INTEREST_SETS,
+                 max_requests: int = MATCH_MAX_REQUESTS):
+        self.destination_threshold = destination_threshold
+        self.interest_threshold = interest_threshold
+        self.max_destinations = max_destinations
+        self.max_interest_sets = max_interest_sets
+        self.max_requests = max_requests
+        self.destinations: "OrderedDict[str, set]" = OrderedDict()
+        self.trigram_index: Dict[str, set] = {}
+        self.interest_sets: "OrderedDict[frozenset, None]" = OrderedDict()
+        self.memo: "OrderedDict[str, dict]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"destinationMatches": 0, "interestMatches": 0, "newDestinations": 0}
+
+    def clean_destination(self, destination: str) -> str:
+        # Strip accents but keep letters of every script, so 東京 and Москва stay distinct
+        text = "".join(c for c in unicodedata.normalize("NFKD", destination.lower()) if not unicodedata.combining(c))
+        text = " ".join(re.sub(r"[\W_]+", " ", text).split())
+        if not text:
+            # Nothing but punctuation or symbols; keep them rather than collapse to ""
+            return " ".join(destination.lower().split())
+        return DESTINATION_ALIASES.get(text, text)
+
+    def match_destination(self, destination: str) -> str:
+        cleaned = self.clean_destination(destination)
+        if cleaned in self.destinations or not cleaned:
+            if cleaned:
+                self.destinations.move_to_end(cleaned)
+            return cleaned
+
+        grams = trigrams(cleaned)
+        words = len(cleaned.split())
+        candidates = set()
+        for gram in grams:
+            candidates |= self.trigram_index.get(gram, set())
+        best, best_score = None, 0.0
+        for candidate in candidates:
+            if len(candidate.split()) != words:
+                continue
+            other = self.destinations[candidate]
+            score = 2 * len(grams & other) / (len(grams) + len(other))
+            if score > best_score:
+                best, best_score = candidate, score
+        if best is not None and best_score >= self.destination_threshold:
+            self.destinations.move_to_end(best)
+            self.stats["destinationMatches"] += 1
+            return best
+
+        self.destinations[cleaned] = grams
+        for gram in grams:
+            self.trigram_index.setdefault(gram, set()).add(cleaned)
+        while len(self.destinations) > self.max_destinations:
+            evicted, evicted_grams = self.destinations.popitem(last=False)
+            for gram in evicted_grams:
+                holders = self.trigram_index[gram]
+                holders.discard(evicted)
+                if not holders:
+                    del self.trigram_index[gram]
+        self.stats["newDestinations"] += 1
+        return cleaned
+
+    def match_interests(self, interests: List[str]) -> List[str]:
+        folded = frozenset(INTEREST_SYNONYMS.get(i, i) for i in interests)
+        if folded in self.interest_sets:
+            self.interest_sets.move_to_end(folded)
+            return sorted(folded)
+        for known in self.interest_sets:
+            if folded and len(folded & known) / len(folded | known) >= self.interest_threshold:
+                self.interest_sets.move_to_end(known)
+                self.stats["interestMatches"] += 1
+                return sorted(known)
+        self.interest_sets[folded] = None
+        while len(self.interest_sets) > self.max_interest_sets:
+            self.interest_sets.popitem(last=False)
+        return sorted(folded)
+
+    def canonicalize(self, request: TravelRequest) -> dict:
+        """Normalized request fields with near-duplicates mapped to their canonical values"""
+        normalized = normalize_request(request)
+        memo_key = json.dumps(normalized, sort_keys=True)
+        with self.lock:
+            if memo_key in self.memo:
+                self.memo.move_to_end(memo_key)
+                return dict(self.memo[memo_key])
+
+            canonical = dict(normalized)
+            canonical["destination"] = self.match_destination(normalized["destination"])
+            canonical["interests"] = self.match_interests(normalized["interests"])
+
+            self.memo[memo_key] = canonical
+            while len(self.memo) > self.max_requests:
+                self.memo.popitem(last=False)
+            return dict(canonical)
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "knownDestinations": len(self.destinations),
+                "knownInterestSets": len(self.interest_sets)}
+
+request_matcher = RequestMatcher(DESTINATION_MATCH_THRESHOLD, INTEREST_MATCH_THRESHOLD)
+
+def request_key(request: TravelRequest) -> str:
+    """Hash of the canonical request; equivalent and near-duplicate requests share it"""
+    encoded = json.dumps(request_matcher.canonicalize(request), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+class AgentCache:
+    """Agent result cache: in-memory LRU with TTL, backed by an optional SQLite tier.
+
+    Values are stored as JSON so callers always get their own copy. The SQLite tier
+    is shared by all worker processes using the same file, so a result generated
+    by one worker is a disk hit for the others. Lookups and writes are coroutines:
+    the in-memory LRU is used on the event loop and the SQLite tier from a thread,
+    so a busy cache file never stalls the loop.
+    """
+    def __init__(self, max_entries: int, ttl_seconds: float, db_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self.entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.lock = threading.Lock()
+        # Separate from `lock` so memory lookups never wait on the disk
+        self.db_lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.db = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            # WAL lets every worker process read while one writes
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS agent_cache "
+                "(key TEXT PRIMARY KEY, expires REAL NOT NULL, value TEXT NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS agent_cache_expires ON agent_cache (expires)")
+            self.db.commit()
+
+    def _count(self, namespace: str, event: str):
+        counts = self.stats.setdefault(namespace, {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0})
+        counts[event] += 1
+
+    async def get(self, namespace: str, key: str) -> Optional[dict]:
+        full_key = f"{namespace}:{key}"
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(full_key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(full_key)
+                self._count(namespace, "hits")
+                return json.loads(entry[1])
+            if entry:
+                del self.entries[full_key]
+
+        if self.db is not None:
+            row = await asyncio.to_thread(self._disk_get, full_key)
+            if row and row[0] > now:
+                with self.lock:
+                    self._store(namespace, full_key, row[0], row[1])
+                    self._count(namespace, "disk_hits")
+                return json.loads(row[1])
+
+        with self.lock:
+            self._count(namespace, "misses")
+        return None
+
+    async def expires_in(self, namespace: str, key: str) -> Optional[float]:
+        """Seconds until an entry expires, or None when absent; does not count as a lookup"""
+        full_key = f"{namespace}:{key}"
+        with self.lock:
+            entry = self.entries.get(full_key)
+        expires = entry[0] if entry else None
+        if expires is None and self.db is not None:
+            row = await asyncio.to_thread(self._disk_get, full_key)
+            expires = row[0] if row else None
+        now = time.time()
+        if expires is None or expires <= now:
+            return None
+        return expires - now
+
+    async def set(self, namespace: str, key: str, value: dict):
+        full_key = f"{namespace}:{key}"
+        expires = time.time() + self.ttl_seconds
+        serialized = json.dumps(value, separators=(",", ":"))
+        with self.lock:
+            self._store(namespace, full_key, expires, serialized)
+        if self.db is not None:
+            await asyncio.to_thread(self._disk_set, full_key, expires, serialized)
+
+    def _disk_get(self, full_key: str) -> Optional[Tuple[float, str]]:
+        with self.db_lock:
+            return self.db.execute("SELECT expires, value FROM agent_cache WHERE key = ?", (full_key,)).fetchone()
+
+    def _disk_set(self, full_key: str, expires: float, serialized: str):
+        with self.db_lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO agent_cache (key, expires, value) VALUES (?, ?, ?)",
+                (full_key, expires, serialized)
+            )
+            self.db.execute("DELETE FROM agent_cache WHERE expires <= ?", (time.time(),))
+            self.db.commit()
+
+    def _store(self, namespace: str, full_key: str, expires: float, serialized: str):
+        self.entries[full_key] = (expires, serialized)
+        self.entries.move_to_end(full_key)
+        while len(self.entries) > self.max_entries:
+            evicted_key, _ = self.entries.popitem(last=False)
+            self._count(evicted_key.split(":", 1)[0], "evictions")
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            totals = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+            for counts in self.stats.values():
+                for event, value in counts.items():
+                    totals[event] += value
+            return {
+                "entries": len(self.entries),
+                "maxEntries": self.max_entries,
+                "ttlSeconds": self.ttl_seconds,
+                "diskTier": self.db_path,
+                "totals": totals,
+                "agents": {namespace: dict(counts) for namespace, counts in self.stats.items()},
+            }
+
+agent_cache: Optional[AgentCache] = None
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one in-flight computation.
+
+    The first caller (the leader) starts the work; callers arriving while it runs
+    await the same task and receive a copy of its result. The shared task is
+    shielded, so a caller that disconnects does not cancel it for the others.
+    A caller more urgent than the work's priority so far (an interactive request
+    joining a prefetch, say) promotes it, including its model calls still queued.
+    """
+    def __init__(self):
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.tickets: Dict[str, dict] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    async def do(self, namespace: str, key: str, compute: Callable[[], Awaitable]):
+        full_key = f"{namespace}:{key}"
+        counts = self.stats.setdefault(namespace, {"leaders": 0, "coalesced": 0})
+        task = self.inflight.get(full_key)
+        if task is not None:
+            counts["coalesced"] += 1
+            self._promote(self.tickets[full_key], effective_priority())
+            return copy.deepcopy(await asyncio.shield(task))
+
+        counts["leaders"] += 1
+        ticket = {"priority": effective_priority(), "waiting": set()}
+        token = current_flights.set((*current_flights.get(), ticket))
+        try:
+            task = asyncio.create_task(compute())
+        finally:
+            current_flights.reset(token)
+        self.inflight[full_key] = task
+        self.tickets[full_key] = ticket
+
+        def done(_):
+            self.inflight.pop(full_key, None)
+            self.tickets.pop(full_key, None)
+
+        task.add_done_callback(done)
+        return await asyncio.shield(task)
+
+    def _promote(self, ticket: dict, priority: str):
+        if PRIORITIES[priority] < PRIORITIES[ticket["priority"]]:
+            ticket["priority"] = priority
+            if model_client is not None:
+                model_client.scheduler.promote(ticket["waiting"], priority)
+
+    def get_stats(self) -> dict:
+        return {
+            "inFlight": len(self.inflight),
+            "callsSaved": sum(counts["coalesced"] for counts in self.stats.values()),
+            "namespaces": {namespace: dict(counts) for namespace, counts in self.stats.items()},
+        }
+
+# Agent calls and whole plans are coalesced separately so their counts stay apart
+agent_flights = SingleFlight()
+plan_flights = SingleFlight()
+
+class SharedFlight:
+    """Cross-process counterpart of SingleFlight for agent calls, kept in the cache file.
+
+    Before generating, a worker claims the call's key in a shared table. A worker
+    that finds the key claimed by another process waits for the result to show up
+    in the shared cache instead of making the same model call; if the claim is
+    released without a cached result (the call fell back) or its lease runs out,
+    it tries to claim the key itself. The leader renews its lease while the call
+    runs, so slow calls are not duplicated. Every query runs in a thread.
+    """
+    def __init__(self, db_path: str, lease_seconds: float):
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.lock = threading.Lock()
+        self.stats = {"leaders": 0, "waited": 0, "shared": 0}
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=5, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS agent_inflight (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+        )
 
-            # Method 2: Try generate_text (older API)
+    def claim(self, key: str) -> bool:
+        now = time.time()
+        with self.lock:
+            self.db.execute("DELETE FROM agent_inflight WHERE key = ? AND expires < ?", (key, now))
+            cursor = self.db.execute("INSERT OR IGNORE INTO agent_inflight VALUES (?, ?, ?)",
+                                     (key, self.owner, now + self.lease_seconds))
+            return cursor.rowcount == 1
+
+    def renew(self, key: str):
+        with self.lock:
+            self.db.execute("UPDATE agent_inflight SET expires = ? WHERE key = ? AND owner = ?",
+                            (time.time() + self.lease_seconds, key, self.owner))
+
+    async def _keep_claim(self, key: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await asyncio.to_thread(self.renew, key)
+
+    def claimed(self, key: str) -> bool:
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM agent_inflight WHERE key = ? AND expires >= ?",
+                                  (key, time.time())).fetchone()
+        return row is not None
+
+    def release(self, key: str):
+        with self.lock:
+            self.db.execute("DELETE FROM agent_inflight WHERE key = ? AND owner = ?", (key, self.owner))
+
+    async def do(self, namespace: str, key: str, compute: Callable[[], Awaitable[Tuple[dict, bool]]],
+                 lookup: Callable[[], Awaitable[Optional[dict]]]) -> Tuple[dict, bool]:
+        """`compute`'s (result, degraded), or another worker's result found by `lookup`"""
+        full_key = f"{namespace}:{key}"
+        while True:
+            if await asyncio.to_thread(self.claim, full_key):
+                self.stats["leaders"] += 1
+                keeper = asyncio.create_task(self._keep_claim(full_key))
+                try:
+                    return await compute()
+                finally:
+                    keeper.cancel()
+                    await asyncio.to_thread(self.release, full_key)
+
+            self.stats["waited"] += 1
+            while await asyncio.to_thread(self.claimed, full_key):
+                await asyncio.sleep(SHARED_FLIGHT_POLL_SECONDS)
+            result = await lookup()
+            if result is not None:
+                self.stats["shared"] += 1
+                return result, False
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            in_flight = self.db.execute("SELECT COUNT(*) FROM agent_inflight").fetchone()[0]
+        return {**self.stats, "inFlightOnHost": in_flight}
+
+shared_flights: Optional[SharedFlight] = None
+
+class PlanStore:
+    """Append-only SQLite store of every plan, written off the request path.
+
+    `add` only assigns an ID, keeps the plan in a small in-memory tier for re-planning
+    and queues it; a background thread serializes queued plans compactly and inserts
+    them in batches. Plans still waiting for the writer are served from memory. Rows are indexed by destination, start date, creation time and
+    request hash, and pruned by age and count according to the retention settings.
+    """
+    def __init__(self, db_path: str, memory_size: int):
+        self.db_path = db_path
+        self.memory_size = memory_size
+        self.recent: "OrderedDict[str, dict]" = OrderedDict()
+        self.queue: "queue.Queue[Optional[dict]]" = queue.Queue()
+        # Queued plans by ID until the writer has inserted them
+        self.pending: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.written = 0
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db = self._connect()
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS plans (
+                plan_id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                destination TEXT NOT NULL,
+                start_date TEXT NOT NULL,
+                end_date TEXT NOT NULL,
+                request_hash TEXT NOT NULL,
+                request TEXT NOT NULL,
+                results TEXT NOT NULL,
+                plan TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS plans_destination ON plans (destination, created_at);
+            CREATE INDEX IF NOT EXISTS plans_start_date ON plans (start_date);
+            CREATE INDEX IF NOT EXISTS plans_created_at ON plans (created_at);
+            CREATE INDEX IF NOT EXISTS plans_request_hash ON plans (request_hash);
+        """)
+        self.writer = threading.Thread(target=self._write_loop, name="plan-store-writer", daemon=True)
+        self.writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
+        # WAL lets readers query while the writer thread appends
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def add(self, request: TravelRequest, results: Dict[str, dict], complete_plan: dict) -> str:
+        """Assign the plan an ID and queue it for writing; never blocks on disk"""
+        plan_id = uuid.uuid4().hex
+        record = {
+            "planId": plan_id,
+            "createdAt": time.time(),
+            "request": request.dict(),
+            "results": results,
+            "degradedSections": complete_plan.get("degradedSections", []),
+        }
+        with self.lock:
+            self.recent[plan_id] = record
+            while len(self.recent) > self.memory_size:
+                self.recent.popitem(last=False)
+        # Shallow copy: callers may add top-level keys to the plan they return
+        plan = {**complete_plan, "planId": plan_id}
+        with self.lock:
+            self.pending[plan_id] = plan
+        self.queue.put({**record, "plan": plan})
+        return plan_id
+
+    def get(self, plan_id: str) -> Optional[dict]:
+        """The request, step results and degraded sections behind a plan, from memory or disk"""
+        with self.lock:
+            record = self.recent.get(plan_id)
+        if record is not None:
+            return record
+        row = self.db.execute(
+            "SELECT request, results, json_extract(plan, '$.degradedSections') FROM plans WHERE plan_id = ?",
+            (plan_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"planId": plan_id, "request": json.loads(row[0]), "results": json.loads(row[1]),
+                "degradedSections": json.loads(row[2] or "[]")}
+
+    def recent_requests(self, since_seconds: float, limit: int) -> List[dict]:
+        rows = self.db.execute(
+            "SELECT request FROM plans WHERE created_at > ? ORDER BY created_at DESC LIMIT ?",
+            (time.time() - since_seconds, limit)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_plan_text(self, plan_id: str) -> Optional[str]:
+        """The stored plan as its compact JSON text, so it can be served without re-serializing"""
+        with self.lock:
+            plan = self.pending.get(plan_id)
+        if plan is not None:
+            # Serialized as the writer will store it, so the ETag does not change once it has
+            return json.dumps(plan, separators=(",", ":"))
+        row = self.db.execute("SELECT plan FROM plans WHERE plan_id = ?", (plan_id,)).fetchone()
+        return row[0] if row else None
+
+    def find(self, destination: Optional[str] = None, start_date: Optional[str] = None,
+             request_hash: Optional[str] = None, limit: int = 50) -> List[dict]:
+        """Summaries of stored plans, newest first"""
+        clauses, params = [], []
+        if destination:
+            clauses.append("destination = ?")
+            params.append(request_matcher.clean_destination(destination))
+        if start_date:
+            clauses.append("start_date = ?")
+            params.append(start_date)
+        if request_hash:
+            clauses.append("request_hash = ?")
+            params.append(request_hash)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self.db.execute(
+            f"SELECT plan_id, created_at, destination, start_date, end_date, request_hash FROM plans "
+            f"{where} ORDER BY created_at DESC LIMIT ?", (*params, limit)
+        ).fetchall()
+        return [
+            {"planId": row[0], "createdAt": datetime.fromtimestamp(row[1]).isoformat(), "destination": row[2],
+             "startDate": row[3], "endDate": row[4], "requestHash": row[5]}
+            for row in rows
+        ]
+
+    def _write_loop(self):
+        db = self._connect()
+        last_prune = 0.0
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + PLAN_STORE_FLUSH_SECONDS
+            while batch[-1] is not None and len(batch) < PLAN_STORE_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            records = [record for record in batch if record is not None]
             try:
-                response = genai.generate_text(
-                    model=f"models/{self.model_name}",
-                    prompt=prompt,
-                    temperature=0.7,
-                    max_output_tokens=2048
+                if records:
+                    self._write(db, records)
+                if time.monotonic() - last_prune > 60 or stopping:
+                    self._prune(db)
+                    last_prune = time.monotonic()
+            except Exception as e:
+                print(f"Error saving travel plans: {str(e)}")
+            with self.lock:
+                for record in records:
+                    self.pending.pop(record["planId"], None)
+            if stopping:
+                db.close()
+                return
+
+    def _write(self, db: sqlite3.Connection, records: List[dict]):
+        rows = []
+        for record in records:
+            request = TravelRequest(**record["request"])
+            normalized = normalize_request(request)
+            rows.append((
+                record["planId"],
+                record["createdAt"],
+                request_matcher.clean_destination(request.destination),
+                normalized["startDate"],
+                normalized["endDate"],
+                request_key(request),
+                json.dumps(record["request"], separators=(",", ":")),
+                json.dumps(record["results"], separators=(",", ":")),
+                json.dumps(record["plan"], separators=(",", ":")),
+            ))
+        with db:
+            db.executemany("INSERT OR IGNORE INTO plans VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.written += len(rows)
+        print(f"Saved {len(rows)} travel plan(s) to: {self.db_path}")
+
+    def _prune(self, db: sqlite3.Connection):
+        with db:
+            if PLAN_STORE_RETENTION_DAYS > 0:
+                cutoff = time.time() - PLAN_STORE_RETENTION_DAYS * 24 * 60 * 60
+                db.execute("DELETE FROM plans WHERE created_at < ?", (cutoff,))
+            if PLAN_STORE_MAX_PLANS > 0:
+                db.execute(
+                    "DELETE FROM plans WHERE plan_id IN (SELECT plan_id FROM plans "
+                    "ORDER BY created_at DESC LIMIT -1 OFFSET ?)", (PLAN_STORE_MAX_PLANS,)
                 )
-                if hasattr(response, 'result'):
-                    return response.result
-                elif hasattr(response, 'text'):
-                    return response.text
-            except:
-                pass
 
-            # Method 3: Try chat interface
+    def close(self):
+        """Flush queued plans and stop the writer"""
+        self.queue.put(None)
+        self.writer.join(timeout=10)
+
+    def get_stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "written": self.written, "inMemory": len(self.recent),
+                "pending": len(self.pending)}
+
+plan_store: Optional[PlanStore] = None
+
+class JobQueue:
+    """Durable SQLite queue of plan jobs, shared by every worker process.
+
+    Jobs are claimed inside an immediate transaction, so any number of uvicorn
+    workers can pull from one queue file. A running job holds a lease its worker
+    keeps renewing; when a lease lapses (the worker died or was restarted) the job
+    is queued again, failing after JOB_MAX_ATTEMPTS. Sections are saved as they
+    finish so clients can show a partial plan.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.last_prune = 0.0
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # Autocommit; claims open their own transaction
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                mode TEXT,
+                request TEXT NOT NULL,
+                sections TEXT NOT NULL DEFAULT '{}',
+                plan TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                lease_until REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+        """)
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self.lock:
+            return self.db.execute(sql, params)
+
+    def enqueue(self, request: TravelRequest, mode: Optional[str] = None) -> str:
+        job_id = uuid.uuid4().hex
+        self._execute(
+            "INSERT INTO jobs (job_id, status, mode, request, created_at) VALUES (?, 'queued', ?, ?, ?)",
+            (job_id, mode, json.dumps(request.dict(), separators=(",", ":")), time.time())
+        )
+        return job_id
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """Take the oldest queued job, first re-queueing jobs whose lease lapsed"""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
             try:
-                chat = genai.GenerativeModel(self.model_name).start_chat(history=[])
-                response = chat.send_message(prompt)
-                return response.text
-            except:
-                pass
+                self.db.execute(
+                    "UPDATE jobs SET status = 'failed', finished_at = ?, error = 'Worker stopped while planning' "
+                    "WHERE status = 'running' AND lease_until < ? AND attempts >= ?", (now, now, JOB_MAX_ATTEMPTS)
+                )
+                self.db.execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND lease_until < ?",
+                    (now,)
+                )
+                row = self.db.execute(
+                    "SELECT job_id, mode, request, attempts FROM jobs WHERE status = 'queued' "
+                    "ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self.db.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                        "started_at = ?, lease_until = ? WHERE job_id = ?",
+                        (worker, now, now + JOB_LEASE_SECONDS, row[0])
+                    )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        if now - self.last_prune > 60:
+            self.last_prune = now
+            self._execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (now - JOB_RETENTION_DAYS * 24 * 60 * 60,)
+            )
+        if row is None:
+            return None
+        return {"jobId": row[0], "mode": row[1], "request": json.loads(row[2]), "attempts": row[3] + 1}
+
+    def renew(self, job_id: str):
+        self._execute("UPDATE jobs SET lease_until = ? WHERE job_id = ? AND status = 'running'",
+                      (time.time() + JOB_LEASE_SECONDS, job_id))
+
+    def save_section(self, job_id: str, section: str, fields: dict):
+        self._execute(
+            "UPDATE jobs SET sections = json_set(sections, '$.' || ?, json(?)), lease_until = ? WHERE job_id = ?",
+            (section, json.dumps(fields, separators=(",", ":")), time.time() + JOB_LEASE_SECONDS, job_id)
+        )
+
+    def complete(self, job_id: str, complete_plan: dict):
+        self._execute(
+            "UPDATE jobs SET status = 'done', plan = ?, finished_at = ? WHERE job_id = ?",
+            (json.dumps(complete_plan, separators=(",", ":")), time.time(), job_id)
+        )
 
-            print(f"{self.role}: All API methods failed")
-            return "{}"
+    def fail(self, job_id: str, error: str):
+        self._execute("UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE job_id = ?",
+                      (error, time.time(), job_id))
 
-        except Exception as e:
-            print(f"Error in {self.role}: {str(e)}")
-            return "{}"
+    def release(self, job_id: str):
+        """Put a job this worker is abandoning (e.g. on shutdown) back in the queue"""
+        self._execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL, attempts = attempts - 1 "
+            "WHERE job_id = ? AND status = 'running'", (job_id,)
+        )
+
+    def get(self, job_id: str) -> Optional[dict]:
+        row = self._execute(
+            "SELECT status, mode, request, sections, plan, error, attempts, created_at, started_at, finished_at "
+            "FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        def timestamp(value: Optional[float]) -> Optional[str]:
+            return datetime.fromtimestamp(value).isoformat() if value else None
+
+        job = {
+            "jobId": job_id,
+            "status": row[0],
+            "mode": row[1],
+            "request": json.loads(row[2]),
+            "sections": json.loads(row[3]),
+            "attempts": row[6],
+            "createdAt": timestamp(row[7]),
+            "startedAt": timestamp(row[8]),
+            "finishedAt": timestamp(row[9]),
+        }
+        if row[4] is not None:
+            job["plan"] = json.loads(row[4])
+        if row[5] is not None:
+            job["error"] = row[5]
+        return job
+
+    def get_stats(self) -> dict:
+        rows = self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {"queued": 0, "running": 0, "done": 0, "failed": 0, **dict(rows)}
+
+job_queue: Optional[JobQueue] = None
+
+def estimate_tokens(text: str) -> int:
+    """Rough Gemini token count (about four characters per token)"""
+    return (len(text) + 3) // 4
+
+def project_items(items: list, fields: Tuple[str, ...], token_budget: int = PROMPT_INPUT_TOKEN_BUDGET,
+                  max_chars: int = 80) -> list:
+    """Upstream list elements cut down to what a downstream prompt uses.
+
+    Dict elements keep only `fields`, with long strings shortened, and elements are
+    taken in order until the next one would exceed `token_budget` estimated tokens.
+    """
+    if not COMPACT_PROMPTS:
+        return items
+    projected, used = [], 0
+    for item in items:
+        if isinstance(item, dict):
+            item = {field: item[field][:max_chars] if isinstance(item[field], str) else item[field]
+                    for field in fields if item.get(field) not in (None, "")}
+        cost = estimate_tokens(json.dumps(item, separators=(",", ":")))
+        if projected and used + cost > token_budget:
+            break
+        projected.append(item)
+        used += cost
+    return projected
+
+class ExecutionStats:
+    """Latency and token totals per execution mode, for comparing fused and split plans"""
+    def __init__(self):
+        self.modes: Dict[str, Dict[str, float]] = {}
+
+    def _totals(self, mode: str) -> Dict[str, float]:
+        return self.modes.setdefault(mode, {
+            "plans": 0, "planSeconds": 0.0, "modelCalls": 0, "promptTokens": 0, "responseTokens": 0
+        })
+
+    def record_call(self, mode: str, prompt: str, response: Optional[str]):
+        totals = self._totals(mode)
+        totals["modelCalls"] += 1
+        totals["promptTokens"] += estimate_tokens(prompt)
+        totals["responseTokens"] += estimate_tokens(response or "")
+
+    def record_plan(self, mode: str, seconds: float):
+        totals = self._totals(mode)
+        totals["plans"] += 1
+        totals["planSeconds"] += seconds
+
+    def get_stats(self) -> dict:
+        stats = {}
+        for mode, totals in self.modes.items():
+            plans = totals["plans"] or 1
+            stats[mode] = {
+                **totals,
+                "avgPlanSeconds": round(totals["planSeconds"] / plans, 3),
+                "avgModelCallsPerPlan": round(totals["modelCalls"] / plans, 2),
+                "avgEstimatedTokensPerPlan": round((totals["promptTokens"] + totals["responseTokens"]) / plans, 1),
+            }
+        return stats
+
+execution_stats = ExecutionStats()
+
+# Execution mode of the plan being built; agent tasks inherit it from the orchestrator
+current_mode: ContextVar[str] = ContextVar("current_mode", default=PLAN_EXECUTION_MODE)
+# Set while re-planning: an edited request must not be answered from a near-duplicate's cache entry
+exact_inputs: ContextVar[bool] = ContextVar("exact_inputs", default=False)
+
+# Monotonic deadline of the plan being built (math.inf for none); unset means PLAN_DEADLINE_SECONDS
+current_deadline: ContextVar[Optional[float]] = ContextVar("current_deadline", default=None)
+# The running step's {"deadline": ..., "degraded": ...}; agents read their budget from it and
+# flag it when they answer with a fallback
+current_step: ContextVar[Optional[dict]] = ContextVar("current_step", default=None)
+
+def plan_deadline(seconds: float) -> float:
+    return time.monotonic() + seconds if seconds > 0 else math.inf
+
+class Agent:
+    """Base Agent class for multi-agent system - FIXED VERSION"""
+    # Normalized request fields this agent's prompt depends on; they form its cache key
+    cache_fields: Tuple[str, ...] = ()
+    # Output description used when this agent is folded into a fused prompt; empty means never fused
+    fused_spec: str = ""
+    # Key of the list in this agent's result whose elements are streamed as they are generated
+    item_key: str = ""
+
+    def __init__(self, role: str, model_name: str = DEFAULT_AGENT_MODEL):
+        self.role = role
+        self.route = ModelRoute.for_role(role, model_name)
+        self.model_name = self.route.model
+        self.use_ai = GEMINI_AVAILABLE and GEMINI_API_KEY
+
+    async def _complete(self, prompt: str) -> Optional[str]:
+        """Call Gemini, returning None when no model response is available"""
+        if not self.use_ai:
+            print(f"{self.role}: Using fallback (AI not configured)")
+            return None
+
+        response = None
+        started = time.monotonic()
+        on_text = None
+        step = current_step.get()
+        if self.item_key and step is not None and step.get("onItem") is not None:
+            stream = JsonStreamParser()
+
+            async def on_text(chunk: str):
+                nonlocal stream
+                if stream is None:
+                    return
+                try:
+                    items = stream.feed(chunk)
+                except Exception as e:
+                    # Previews are best effort; the full response is still parsed at the end
+                    print(f"{self.role}: Stopped streaming items: {str(e)}")
+                    stream = None
+                    return
+                for key, item in items:
+                    if key in (None, self.item_key):
+                        await step["onItem"](item)
+
+        with trace_span(f"model:{self.role}", promptTokens=estimate_tokens(prompt)) as span:
+            try:
+                response = await model_client.generate(self.model_name, prompt, self.role, on_text,
+                                                       self.route.generation_config())
+                return response
+
+            except Exception as e:
+                print(f"Error in {self.role}: {str(e)}")
+                AGENT_ERRORS.inc(agent=self.role, error=type(e).__name__)
+                span["error"] = type(e).__name__
+                return None
+            finally:
+                AGENT_CALL_SECONDS.observe(time.monotonic() - started, agent=self.role)
+                AGENT_PROMPT_TOKENS.observe(estimate_tokens(prompt), agent=self.role)
+                AGENT_RESPONSE_TOKENS.observe(estimate_tokens(response or ""), agent=self.role)
+                span["responseTokens"] = estimate_tokens(response or "")
+                execution_stats.record_call(current_mode.get(), prompt, response)
+
+    async def generate(self, prompt: str) -> str:
+        """Generate response from Gemini with fallback"""
+        return await self._complete(prompt) or "{}"
+
+    def prompt_inputs(self, request: TravelRequest, canonical: bool = True) -> dict:
+        """The request fields this agent's prompt uses, canonicalized for near-duplicate reuse"""
+        normalized = request_matcher.canonicalize(request) if canonical else normalize_request(request)
+        return {field: normalized[field] for field in self.cache_fields}
+
+    def cache_key(self, request: TravelRequest, *inputs) -> str:
+        payload = self.prompt_inputs(request, canonical=not exact_inputs.get())
+        if inputs:
+            payload["inputs"] = inputs
+        encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def build_prompt(self, request: TravelRequest, *inputs) -> str:
+        raise NotImplementedError
+
+    def parse(self, response: str, request: TravelRequest, *inputs) -> dict:
+        """Turn a model response into this agent's section; raises if unusable"""
+        raise NotImplementedError
+
+    def fallback(self, request: TravelRequest, *inputs) -> dict:
+        raise NotImplementedError
+
+    async def run(self, request: TravelRequest, *inputs) -> dict:
+        """Serve from cache, otherwise prompt the model and parse, falling back on failure.
+
+        Concurrent calls with the same cache key share a single model call. The call is
+        bounded by the route's timeout and, inside a plan step, the step's deadline;
+        past either the fallback is returned, while the model call carries on to warm
+        the cache.
+        """
+        key = self.cache_key(request, *inputs)
+        cached = await agent_cache.get(self.role, key)
+        if cached is not None:
+            print(f"{self.role}: Cache hit")
+            AGENT_RESULTS.inc(agent=self.role, outcome="cache_hit")
+            return cached
+
+        step = current_step.get()
+        deadline = step["deadline"] if step is not None else math.inf
+        if self.route.timeout:
+            deadline = min(deadline, time.monotonic() + self.route.timeout)
+        if math.isinf(deadline):
+            return await self.refresh(request, *inputs)
+        try:
+            return await asyncio.wait_for(self.refresh(request, *inputs), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            print(f"{self.role}: Missed its deadline, using fallback")
+            AGENT_RESULTS.inc(agent=self.role, outcome="timeout")
+            if step is not None:
+                step["degraded"] = True
+            return self.fallback(request, *inputs)
+
+    async def refresh(self, request: TravelRequest, *inputs) -> dict:
+        """Generate a fresh result, bypassing but updating the cache.
+
+        Concurrent calls share one generation in this process and, through the
+        shared cache file, with other worker processes.
+        """
+        key = self.cache_key(request, *inputs)
+
+        async def generate() -> Tuple[dict, bool]:
+            if shared_flights is None:
+                return await self._generate_result(key, request, *inputs)
+            return await shared_flights.do(self.role, key, lambda: self._generate_result(key, request, *inputs),
+                                           lambda: agent_cache.get(self.role, key))
+
+        result, degraded = await agent_flights.do(self.role, key, generate)
+        step = current_step.get()
+        if degraded and step is not None:
+            step["degraded"] = True
+        return result
+
+    async def _generate_result(self, key: str, request: TravelRequest, *inputs) -> Tuple[dict, bool]:
+        """The agent's result, and whether it is a fallback rather than model output"""
+        response = await self._complete(self.build_prompt(request, *inputs))
+        if response is None:
+            # No model, or the call failed (circuit open, retries exhausted)
+            AGENT_RESULTS.inc(agent=self.role, outcome="fallback")
+            return self.fallback(request, *inputs), True
+        # Runs as its own single-flight task, so this does not leak to the caller
+        report = {"truncated": False}
+        current_parse.set(report)
+        try:
+            result = self.parse(response, request, *inputs)
+        except:
+            AGENT_RESULTS.inc(agent=self.role, outcome="fallback")
+            return self.fallback(request, *inputs), True
+
+        # Only complete model output is worth keeping; a truncated response that was
+        # salvaged is used, with the fallback filling in whatever it is missing
+        if report["truncated"]:
+            print(f"{self.role}: Salvaged a truncated response")
+            result = {**self.fallback(request, *inputs), **result}
+            AGENT_RESULTS.inc(agent=self.role, outcome="salvaged")
+        else:
+            # A result built on placeholder inputs is as degraded as they are
+            step = current_step.get()
+            if step is None or not step.get("inputsDegraded"):
+                await agent_cache.set(self.role, key, result)
+            AGENT_RESULTS.inc(agent=self.role, outcome="parsed")
+        return result, False
 
 class PlanningAgent(Agent):
     """Agent responsible for overall trip planning"""
+    cache_fields = ("destination", "startDate", "endDate", "duration", "travelers", "budget", "interests")
+    fused_spec = ("an object with duration (number of days), overview (total estimated cost, key "
+                  "highlights), bestTime and tips (general tips for the destination)")
+
     def __init__(self):
         super().__init__("Trip Planner")
 
-    def create_plan(self, request: TravelRequest) -> dict:
-        prompt = f"""
+    async def create_plan(self, request: TravelRequest) -> dict:
+        return await self.run(request)
+
+    def build_prompt(self, request: TravelRequest) -> str:
+        return f"""
         You are an expert travel planner. Create a comprehensive travel plan with the following details:
 
         Destination: {request.destination}
@@ -126,32 +1993,34 @@ class PlanningAgent(Agent):
         Return ONLY valid JSON, no markdown formatting.
         """
 
-        response = self.generate(prompt)
-        try:
-            return json.loads(response.replace('```json', '').replace('```', '').strip())
-        except:
-            return {
-                "duration": self._calculate_days(request.startDate, request.endDate),
-                "overview": {"totalCost": request.budget or "2500", "highlights": []},
-                "bestTime": "Year-round",
-                "tips": []
-            }
+    def parse(self, response: str, request: TravelRequest) -> dict:
+        return load_json_response(response)
+
+    def fallback(self, request: TravelRequest) -> dict:
+        return {
+            "duration": self._calculate_days(request.startDate, request.endDate),
+            "overview": {"totalCost": request.budget or "2500", "highlights": []},
+            "bestTime": "Year-round",
+            "tips": []
+        }
 
     def _calculate_days(self, start: str, end: str) -> int:
-        try:
-            start_date = datetime.strptime(start, "%Y-%m-%d")
-            end_date = datetime.strptime(end, "%Y-%m-%d")
-            return (end_date - start_date).days
-        except:
-            return 3
+        return calculate_days(start, end)
 
 class TransportationAgent(Agent):
     """Agent for booking flights and car rentals"""
+    cache_fields = ("destination", "startDate", "endDate", "duration", "travelers", "budget")
+    fused_spec = ("an object with flights (outbound and return with estimated prices), carRental (type of car, daily rate, "
+                  "recommended company) and localTransportation (public transit options, ride-sharing info)")
+
     def __init__(self):
         super().__init__("Transportation Specialist")
 
-    def plan_transportation(self, request: TravelRequest) -> dict:
-        prompt = f"""
+    async def plan_transportation(self, request: TravelRequest) -> dict:
+        return await self.run(request)
+
+    def build_prompt(self, request: TravelRequest) -> str:
+        return f"""
         You are a transportation booking expert. Find the best transportation options for:
 
         Destination: {request.destination}
@@ -167,29 +2036,36 @@ class TransportationAgent(Agent):
         Return ONLY valid JSON, no markdown formatting.
         """
 
-        response = self.generate(prompt)
-        try:
-            return json.loads(response.replace('```json', '').replace('```', '').strip())
-        except:
-            return {
-                "flights": {
-                    "outbound": f"Flight to {request.destination} - $450/person",
-                    "return": "Return flight - $480/person"
-                },
-                "carRental": f"Compact SUV - $65/day",
-                "localTransportation": "Public transit and ride-sharing available"
-            }
+    def parse(self, response: str, request: TravelRequest) -> dict:
+        return load_json_response(response)
+
+    def fallback(self, request: TravelRequest) -> dict:
+        return {
+            "flights": {
+                "outbound": f"Flight to {request.destination} - $450/person",
+                "return": "Return flight - $480/person"
+            },
+            "carRental": f"Compact SUV - $65/day",
+            "localTransportation": "Public transit and ride-sharing available"
+        }
 
 class AccommodationAgent(Agent):
     """Agent for hotel recommendations"""
+    cache_fields = ("destination", "startDate", "endDate", "duration", "travelers", "budget", "interests")
+    fused_spec = ("4-5 hotels within the per-night budget, each with hotel (name), location (area/neighborhood), pricePerNight "
+                  "(number), amenities (list of strings), description and link (official website or Google Maps link)")
+
     def __init__(self):
         super().__init__("Accommodation Expert")
 
-    def find_hotels(self, request: TravelRequest) -> dict:
+    async def find_hotels(self, request: TravelRequest) -> dict:
+        return await self.run(request)
+
+    def build_prompt(self, request: TravelRequest) -> str:
         days = self._calculate_days(request.startDate, request.endDate)
         budget_per_night = int(request.budget) // days if request.budget and days > 0 else 150
 
-        prompt = f"""
+        return f"""
         You are a hotel booking expert. Find the best accommodation for:
 
         Destination: {request.destination}
@@ -209,33 +2085,36 @@ class AccommodationAgent(Agent):
         Return ONLY valid JSON, no markdown formatting.
         """
 
-        response = self.generate(prompt)
-        try:
-            return json.loads(response.replace('```json', '').replace('```', '').strip())
-        except:
-            return {
-                "hotel": f"Hotel in {request.destination}",
-                "location": "City Center",
-                "pricePerNight": 189,
-                "amenities": ["Free WiFi", "Breakfast", "Pool", "Gym"],
-                "description": "Centrally located hotel"
-            }
+    def parse(self, response: str, request: TravelRequest) -> dict:
+        return load_json_response(response)
+
+    def fallback(self, request: TravelRequest) -> dict:
+        return {
+            "hotel": f"Hotel in {request.destination}",
+            "location": "City Center",
+            "pricePerNight": 189,
+            "amenities": ["Free WiFi", "Breakfast", "Pool", "Gym"],
+            "description": "Centrally located hotel"
+        }
 
     def _calculate_days(self, start: str, end: str) -> int:
-        try:
-            start_date = datetime.strptime(start, "%Y-%m-%d")
-            end_date = datetime.strptime(end, "%Y-%m-%d")
-            return max((end_date - start_date).days, 1)
-        except:
-            return 1
+        return max(calculate_days(start, end, default=1), 1)
 
 class AttractionsAgent(Agent):
     """Agent for finding tourist attractions and activities"""
+    cache_fields = ("destination", "duration", "interests")
+    item_key = "attractions"
+    fused_spec = ("an array of 5-8 must-visit places (famous landmarks, national parks, hidden gems), each with name, type "
+                  "(landmark, museum, park, etc.), duration (time to visit), cost (entry fee) and bestTime (when to visit)")
+
     def __init__(self):
         super().__init__("Attractions Guide")
 
-    def find_attractions(self, request: TravelRequest) -> dict:
-        prompt = f"""
+    async def find_attractions(self, request: TravelRequest) -> dict:
+        return await self.run(request)
+
+    def build_prompt(self, request: TravelRequest) -> str:
+        return f"""
         You are a local tourism expert. Find the best attractions and activities for:
 
         Destination: {request.destination}
@@ -253,39 +2132,42 @@ class AttractionsAgent(Agent):
         Return ONLY valid JSON array, no markdown formatting.
         """
 
-        response = self.generate(prompt)
-        try:
-            data = json.loads(response.replace('```json', '').replace('```', '').strip())
-            attractions = data if isinstance(data, list) else data.get("attractions", [])
-            return {"attractions": attractions}
-        except:
-            return {
-                "attractions": [
-                    {
-                        "name": f"Famous landmark in {request.destination}",
-                        "type": "Landmark",
-                        "duration": "2-3 hours",
-                        "cost": "Free",
-                        "bestTime": "Morning"
-                    }
-                ]
-            }
+    def parse(self, response: str, request: TravelRequest) -> dict:
+        data = load_json_response(response)
+        attractions = data if isinstance(data, list) else data.get("attractions", [])
+        return {"attractions": attractions}
+
+    def fallback(self, request: TravelRequest) -> dict:
+        return {
+            "attractions": [
+                {
+                    "name": f"Famous landmark in {request.destination}",
+                    "type": "Landmark",
+                    "duration": "2-3 hours",
+                    "cost": "Free",
+                    "bestTime": "Morning"
+                }
+            ]
+        }
 
     def _calculate_days(self, start: str, end: str) -> int:
-        try:
-            start_date = datetime.strptime(start, "%Y-%m-%d")
-            end_date = datetime.strptime(end, "%Y-%m-%d")
-            return (end_date - start_date).days
-        except:
-            return 3
+        return calculate_days(start, end)
 
 class RestaurantAgent(Agent):
     """Agent for restaurant recommendations"""
+    cache_fields = ("destination", "travelers", "interests")
+    item_key = "restaurants"
+    fused_spec = ("an array of 4-6 restaurants mixing local favorites, famous spots and hidden gems, each with name, "
+                  "cuisine, specialty, priceRange ($, $$, or $$$), mustTry (specific dishes to order) and link")
+
     def __init__(self):
         super().__init__("Food Expert")
 
-    def recommend_restaurants(self, request: TravelRequest) -> dict:
-        prompt = f"""
+    async def recommend_restaurants(self, request: TravelRequest) -> dict:
+        return await self.run(request)
+
+    def build_prompt(self, request: TravelRequest) -> str:
+        return f"""
         You are a local food expert. Recommend the best restaurants and local dishes for:
 
         Destination: {request.destination}
@@ -305,39 +2187,83 @@ class RestaurantAgent(Agent):
         Return ONLY valid JSON array, no markdown formatting.
         """
 
-        response = self.generate(prompt)
-        try:
-            data = json.loads(response.replace('```json', '').replace('```', '').strip())
-            restaurants = data if isinstance(data, list) else data.get("restaurants", [])
-            return {"restaurants": restaurants}
-        except:
-            return {
-                "restaurants": [
-                    {
-                        "name": "Local Restaurant",
-                        "cuisine": "Local",
-                        "specialty": "Traditional dishes",
-                        "priceRange": "$$",
-                        "mustTry": "Local specialty"
-                    }
-                ]
-            }
+    def parse(self, response: str, request: TravelRequest) -> dict:
+        data = load_json_response(response)
+        restaurants = data if isinstance(data, list) else data.get("restaurants", [])
+        return {"restaurants": restaurants}
+
+    def fallback(self, request: TravelRequest) -> dict:
+        return {
+            "restaurants": [
+                {
+                    "name": "Local Restaurant",
+                    "cuisine": "Local",
+                    "specialty": "Traditional dishes",
+                    "priceRange": "$$",
+                    "mustTry": "Local specialty"
+                }
+            ]
+        }
 
 class ItineraryAgent(Agent):
     """Agent for creating daily itinerary"""
+    cache_fields = ("destination", "duration")
+    item_key = "activities"
+    # The only upstream fields the schedule needs
+    attraction_fields = ("name", "type", "duration", "bestTime")
+    restaurant_fields = ("name", "cuisine", "priceRange")
+
     def __init__(self):
         super().__init__("Itinerary Planner")
 
-    def create_itinerary(self, request: TravelRequest, attractions: list, restaurants: list) -> dict:
+    async def create_itinerary(self, request: TravelRequest, attractions: list, restaurants: list) -> dict:
         duration = self._calculate_days(request.startDate, request.endDate)
+        if duration <= ITINERARY_CHUNK_DAYS:
+            return await self.run(request, *self._project(attractions[:10], restaurants[:5]))
+        return await self._create_chunked_itinerary(request, duration, attractions, restaurants)
+
+    def _project(self, attractions: list, restaurants: list) -> Tuple[list, list]:
+        """Done before the cache lookup, so details that do not reach the prompt do not split the key"""
+        return (project_items(attractions, self.attraction_fields),
+                project_items(restaurants, self.restaurant_fields))
+
+    async def _create_chunked_itinerary(self, request: TravelRequest, duration: int,
+                                        attractions: list, restaurants: list) -> dict:
+        """Generate long trips as day-range chunks in parallel and merge them in day order.
+
+        Attractions and restaurants are split between chunks so that no chunk repeats
+        places another chunk already covers. Very long trips get wider chunks rather
+        than more of them.
+        """
+        chunk_days = max(ITINERARY_CHUNK_DAYS, math.ceil(duration / ITINERARY_MAX_CHUNKS))
+        day_ranges = [(first, min(first + chunk_days - 1, duration))
+                      for first in range(1, duration + 1, chunk_days)]
+        chunk_count = len(day_ranges)
+        print(f"{self.role}: Splitting {duration} days into {chunk_count} chunks...")
+
+        chunks = await asyncio.gather(*(
+            self.run(request, *self._project(attractions[index::chunk_count], restaurants[index::chunk_count]),
+                     day_range)
+            for index, day_range in enumerate(day_ranges)
+        ))
+        activities = [activity for chunk in chunks for activity in chunk.get("activities", [])]
+        return {"activities": activities}
+
+    def build_prompt(self, request: TravelRequest, attractions: list, restaurants: list,
+                     days: Optional[Tuple[int, int]] = None) -> str:
+        duration = self._calculate_days(request.startDate, request.endDate)
+        schedule = f"Duration: {duration} days"
+        if days:
+            schedule = (f"Days: {days[0]} to {days[1]} of a {duration}-day trip "
+                        f"(other days are planned separately; suggest new places if the lists run out)")
 
-        prompt = f"""
+        return f"""
         You are an itinerary planning expert. Create a day-by-day schedule for:
 
         Destination: {request.destination}
-        Duration: {duration} days
-        Attractions: {json.dumps(attractions[:10])}
-        Restaurants: {json.dumps(restaurants[:5])}
+        {schedule}
+        Attractions: {json.dumps(attractions)}
+        Restaurants: {json.dumps(restaurants)}
 
         Create a detailed daily itinerary in JSON format as an array. For each day provide:
         - day (number)
@@ -349,38 +2275,49 @@ class ItineraryAgent(Agent):
         Return ONLY valid JSON array, no markdown formatting.
         """
 
-        response = self.generate(prompt)
-        try:
-            data = json.loads(response.replace('```json', '').replace('```', '').strip())
-            activities = data if isinstance(data, list) else data.get("activities", [])
-            return {"activities": activities}
-        except:
-            return {
-                "activities": [
-                    {
-                        "day": i+1,
-                        "morning": "Explore local area",
-                        "afternoon": "Visit main attractions",
-                        "evening": "Dinner and relaxation"
-                    } for i in range(duration)
-                ]
-            }
+    def parse(self, response: str, request: TravelRequest, attractions: list, restaurants: list,
+              days: Optional[Tuple[int, int]] = None) -> dict:
+        data = load_json_response(response)
+        activities = data if isinstance(data, list) else data.get("activities", [])
+        if days:
+            # Chunks sometimes restart numbering at 1; number them by position instead
+            for offset, activity in enumerate(activities):
+                if isinstance(activity, dict) and not days[0] <= activity.get("day", 0) <= days[1]:
+                    activity["day"] = days[0] + offset
+        return {"activities": activities}
+
+    def fallback(self, request: TravelRequest, attractions: list, restaurants: list,
+                 days: Optional[Tuple[int, int]] = None) -> dict:
+        first, last = days or (1, self._calculate_days(request.startDate, request.endDate))
+        return {
+            "activities": [
+                {
+                    "day": day,
+                    "morning": "Explore local area",
+                    "afternoon": "Visit main attractions",
+                    "evening": "Dinner and relaxation"
+                } for day in range(first, last + 1)
+            ]
+        }
 
     def _calculate_days(self, start: str, end: str) -> int:
-        try:
-            start_date = datetime.strptime(start, "%Y-%m-%d")
-            end_date = datetime.strptime(end, "%Y-%m-%d")
-            return (end_date - start_date).days
-        except:
-            return 3
+        return calculate_days(start, end)
 
 class LocalTipsAgent(Agent):
     """Agent for local tips and advice"""
+    cache_fields = ("destination",)
+    item_key = "localTips"
+    fused_spec = ("an array of 6-8 tip strings covering local customs, transportation, safety, money, best "
+                  "times for attractions, useful phrases, what to pack and insider secrets")
+
     def __init__(self):
         super().__init__("Local Expert")
 
-    def get_local_tips(self, request: TravelRequest) -> dict:
-        prompt = f"""
+    async def get_local_tips(self, request: TravelRequest) -> dict:
+        return await self.run(request)
+
+    def build_prompt(self, request: TravelRequest) -> str:
+        return f"""
         You are a local expert for {request.destination}. Provide essential tips for travelers:
 
         Provide 6-8 important local tips as a JSON array of strings including:
@@ -396,22 +2333,119 @@ class LocalTipsAgent(Agent):
         Return ONLY valid JSON array of tip strings, no markdown formatting.
         """
 
-        response = self.generate(prompt)
+    def parse(self, response: str, request: TravelRequest) -> dict:
+        data = load_json_response(response)
+        tips = data if isinstance(data, list) else data.get("localTips", [])
+        return {"localTips": tips}
+
+    def fallback(self, request: TravelRequest) -> dict:
+        return {
+            "localTips": [
+                f"Research local customs in {request.destination}",
+                "Book popular attractions in advance",
+                "Learn a few local phrases",
+                "Keep emergency contacts handy"
+            ]
+        }
+
+class FusedAgent(Agent):
+    """Answers several independent agents' questions with a single prompt"""
+    def __init__(self):
+        super().__init__("Fused Planner")
+
+    async def run_sections(self, request: TravelRequest, agents: Dict[str, Agent]) -> Dict[str, dict]:
+        """Results for every section that was cached or parsed from the fused response.
+
+        Sections missing from the result must be produced by their own agent.
+        """
+        results = {}
+        pending = {}
+        for name, agent in agents.items():
+            cached = await agent_cache.get(agent.role, agent.cache_key(request))
+            if cached is not None:
+                results[name] = cached
+                AGENT_RESULTS.inc(agent=agent.role, outcome="cache_hit")
+            else:
+                pending[name] = agent
+
+        # A single section gains nothing from fusing
+        if len(pending) < 2:
+            return results
+
+        response = await self._complete(self.build_prompt(request, pending))
+        if response is None:
+            return results
+        report = {"truncated": False}
+        token = current_parse.set(report)
         try:
-            data = json.loads(response.replace('```json', '').replace('```', '').strip())
-            tips = data if isinstance(data, list) else data.get("localTips", [])
-            return {"localTips": tips}
+            data = load_json_response(response)
         except:
-            return {
-                "localTips": [
-                    f"Research local customs in {request.destination}",
-                    "Book popular attractions in advance",
-                    "Learn a few local phrases",
-                    "Keep emergency contacts handy"
-                ]
-            }
+            print(f"{self.role}: Could not parse fused response, using per-agent calls")
+            return results
+        finally:
+            current_parse.reset(token)
+
+        for name, agent in pending.items():
+            if not isinstance(data, dict) or name not in data:
+                continue
+            try:
+                result = agent.parse(json.dumps(data[name]), request)
+            except:
+                continue
+            results[name] = result
+            # The last section of a truncated response may be cut short
+            if report["truncated"]:
+                AGENT_RESULTS.inc(agent=agent.role, outcome="salvaged")
+                continue
+            await agent_cache.set(agent.role, agent.cache_key(request), result)
+            AGENT_RESULTS.inc(agent=agent.role, outcome="parsed")
+        return results
+
+    def build_prompt(self, request: TravelRequest, agents: Dict[str, Agent]) -> str:
+        days = max(calculate_days(request.startDate, request.endDate, default=1), 1)
+        budget_per_night = int(request.budget) // days if request.budget and request.budget.isdigit() else 150
+        sections = "\n".join(f'        - "{name}": {agent.fused_spec}' for name, agent in agents.items())
+
+        return f"""
+        You are a team of travel experts planning one trip:
+
+        Destination: {request.destination}
+        Dates: {request.startDate} to {request.endDate} ({calculate_days(request.startDate, request.endDate)} days)
+        Number of travelers: {request.travelers}
+        Budget: ${request.budget if request.budget else 'Not specified'}
+        Budget per night: ${budget_per_night}
+        Interests: {', '.join(request.interests) if request.interests else 'General tourism'}
+
+        Return ONE JSON object with exactly these keys:
+{sections}
+
+        Return ONLY valid JSON, no markdown formatting.
+        """
 
 # Multi-Agent Orchestrator
+# Called with (section name, plan fields) each time a step's section is ready
+SectionCallback = Callable[[str, dict], Awaitable[None]]
+# Called with (section name, list element) as a streamed section's elements are generated
+ItemCallback = Callable[[str, object], Awaitable[None]]
+
+class PlanStep:
+    """A node in the agent dependency graph.
+
+    `weight` is the step's typical duration relative to other steps; it decides the
+    step's share of the plan deadline.
+    """
+    def __init__(self, name: str, description: str, agent: Agent, run: Callable[..., Awaitable[dict]],
+                 section: str, fields: Callable[[TravelRequest, dict], dict], deps: Tuple[str, ...] = (),
+                 weight: float = 1.0):
+        self.name = name
+        self.description = description
+        self.agent = agent
+        self.run = run
+        self.section = section
+        self.fields = fields
+        self.deps = deps
+        self.weight = weight
+
 class TravelPlannerOrchestrator:
     """Orchestrates all agents to create comprehensive travel plan"""
     def __init__(self):
@@ -423,46 +2457,52 @@ class TravelPlannerOrchestrator:
         self.restaurant_agent = RestaurantAgent()
         self.itinerary_agent = ItineraryAgent()
         self.tips_agent = LocalTipsAgent()
+        self.fused_agent = FusedAgent()
+
+        # Each step lists the steps whose output it needs; everything else runs concurrently
+        # and `fields` maps the step's result onto its keys of the complete plan
+        self.steps = [
+            PlanStep("plan", "Planning overall trip", self.planning_agent, self.planning_agent.create_plan,
+                     "overview", self._overview_fields),
+            PlanStep("transportation", "Finding transportation options",
+                     self.transportation_agent, self.transportation_agent.plan_transportation,
+                     "transportation", lambda request, result: {"transportation": result}),
+            PlanStep("accommodation", "Finding accommodations", self.accommodation_agent, self.accommodation_agent.find_hotels,
+                     "accommodation", lambda request, result: {"accommodation": result}),
+            PlanStep("attractions", "Discovering attractions", self.attractions_agent, self.attractions_agent.find_attractions,
+                     "attractions", lambda request, result: {"attractions": result.get("attractions", [])}),
+            PlanStep("restaurants", "Finding best restaurants",
+                     self.restaurant_agent, self.restaurant_agent.recommend_restaurants,
+                     "restaurants", lambda request, result: {"restaurants": result.get("restaurants", [])}),
+            PlanStep("itinerary", "Creating daily itinerary", self.itinerary_agent, self._create_itinerary,
+                     "activities", lambda request, result: {"activities": result.get("activities", [])},
+                     deps=("attractions", "restaurants"), weight=2.0),
+            PlanStep("tips", "Gathering local tips", self.tips_agent, self.tips_agent.get_local_tips,
+                     "localTips", lambda request, result: {"localTips": result.get("localTips", [])}),
+        ]
+        # Weight of the longest chain of steps that must still run after each step
+        self.tails: Dict[str, float] = {}
+        for step in reversed(self.steps):
+            dependents = [other for other in self.steps if step.name in other.deps]
+            self.tails[step.name] = max((other.weight + self.tails[other.name] for other in dependents), default=0.0)
         print("All agents initialized successfully!")
 
-    def create_travel_plan(self, request: TravelRequest) -> dict:
-        """Coordinate all agents to create complete travel plan"""
-        print(f"Creating travel plan for {request.destination}...")
-
-        # Step 1: Overall planning
-        print("Agent 1: Planning overall trip...")
-        plan = self.planning_agent.create_plan(request)
-
-        # Step 2: Transportation
-        print("Agent 2: Finding transportation options...")
-        transportation = self.transportation_agent.plan_transportation(request)
-
-        # Step 3: Accommodation
-        print("Agent 3: Finding accommodations...")
-        accommodation = self.accommodation_agent.find_hotels(request)
-
-        # Step 4: Attractions
-        print("Agent 4: Discovering attractions...")
-        attractions_data = self.attractions_agent.find_attractions(request)
+    def step_deadline(self, step: PlanStep, deadline: float) -> float:
+        """The step's share of the time left, leaving room for the steps that wait on it"""
+        if math.isinf(deadline):
+            return deadline
+        now = time.monotonic()
+        return now + max(0.0, deadline - now) * step.weight / (step.weight + self.tails[step.name])
 
-        # Step 5: Restaurants
-        print("Agent 5: Finding best restaurants...")
-        restaurants_data = self.restaurant_agent.recommend_restaurants(request)
-
-        # Step 6: Daily Itinerary
-        print("Agent 6: Creating daily itinerary...")
-        itinerary = self.itinerary_agent.create_itinerary(
+    async def _create_itinerary(self, request: TravelRequest, attractions_data: dict, restaurants_data: dict) -> dict:
+        return await self.itinerary_agent.create_itinerary(
             request,
             attractions_data.get("attractions", []),
             restaurants_data.get("restaurants", [])
         )
 
-        # Step 7: Local Tips
-        print("Agent 7: Gathering local tips...")
-        tips = self.tips_agent.get_local_tips(request)
-
-        # Combine all results
-        complete_plan = {
+    def _overview_fields(self, request: TravelRequest, plan: dict) -> dict:
+        return {
             "destination": request.destination,
             "duration": plan.get("duration", 0),
             "overview": {
@@ -470,21 +2510,597 @@ class TravelPlannerOrchestrator:
                 "travelers": request.travelers,
                 "startDate": request.startDate,
                 "endDate": request.endDate
-            },
-            "transportation": transportation,
-            "accommodation": accommodation,
-            "attractions": attractions_data.get("attractions", []),
-            "restaurants": restaurants_data.get("restaurants", []),
-            "activities": itinerary.get("activities", []),
-            "localTips": tips.get("localTips", [])
+            }
         }
 
+    async def _run_steps(self, request: TravelRequest, on_section: Optional[SectionCallback] = None,
+                         previous: Optional[Dict[str, dict]] = None, unchanged: set = frozenset(),
+                         degraded: Optional[set] = None, on_item: Optional[ItemCallback] = None) -> Dict[str, dict]:
+        """Run every step as soon as its dependencies have finished.
+
+        A step named in `unchanged` reuses its `previous` result when its dependencies
+        also produced their previous results, e.g. the itinerary when attractions and
+        restaurants come back the same.
+        In fused mode the independent steps are first answered by one combined prompt;
+        any section it does not produce falls back to the step's own agent.
+        Steps share the plan deadline by their weight on the critical path; the names of
+        steps that answered with a fallback are added to `degraded`, as are steps built on
+        a degraded step's output (the itinerary from placeholder attractions), whose
+        results are then not cached.
+        `on_item` is awaited with list elements (attractions, restaurants, itinerary
+        days, tips) as the model generates them, before their section is complete.
+        """
+        previous = previous or {}
+        degraded = degraded if degraded is not None else set()
+        deadline = current_deadline.get()
+        if deadline is None:
+            deadline = plan_deadline(PLAN_DEADLINE_SECONDS)
+        tasks: Dict[str, asyncio.Task] = {}
+        fused: Optional[asyncio.Task] = None
+        if current_mode.get() == "fused":
+            agents = {step.name: step.agent for step in self.steps
+                      if step.agent.fused_spec and not step.deps and step.name not in unchanged}
+            print(f"Fusing {len(agents)} agents into one prompt...")
+            fused = asyncio.create_task(self.fused_agent.run_sections(request, agents))
+
+        async def run_step(index: int, step: PlanStep) -> dict:
+            inputs = [await tasks[dep] for dep in step.deps]
+            started = time.monotonic()
+            inputs_degraded = any(dep in degraded for dep in step.deps)
+            # This task's own context, so the status stays with this step
+            status = {"deadline": self.step_deadline(step, deadline), "degraded": inputs_degraded,
+                      "inputsDegraded": inputs_degraded, "onItem": None}
+            if on_item:
+                async def emit_item(item):
+                    # A call that overran the deadline keeps generating after its section was sent
+                    if status["onItem"] is not None:
+                        await on_item(step.section, item)
+                status["onItem"] = emit_item
+            current_step.set(status)
+            with trace_span(f"step:{step.name}") as span:
+                result = None
+                if step.name in unchanged and inputs == [previous[dep] for dep in step.deps]:
+                    result = previous[step.name]
+                    span["reused"] = True
+                if result is None:
+                    print(f"Agent {index}: {step.description}...")
+                if result is None and fused is not None and step.agent.fused_spec and not step.deps:
+                    try:
+                        timeout = None if math.isinf(status["deadline"]) else max(0.0, status["deadline"] - time.monotonic())
+                        result = (await asyncio.wait_for(asyncio.shield(fused), timeout)).get(step.name)
+                    except asyncio.TimeoutError:
+                        print(f"Agent {index}: Fused prompt missed the deadline")
+                    span["fused"] = result is not None
+                if result is None:
+                    result = await step.run(request, *inputs)
+                status["onItem"] = None
+                if status["degraded"]:
+                    degraded.add(step.name)
+                    span["degraded"] = True
+            STEP_SECONDS.observe(time.monotonic() - started, step=step.name)
+            if on_section:
+                await on_section(step.section, step.fields(request, result))
+            return result
+
+        # Steps are declared in dependency order, so every dep already has a task
+        for index, step in enumerate(self.steps, start=1):
+            tasks[step.name] = asyncio.create_task(run_step(index, step))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            if fused is not None:
+                fused.cancel()
+        return {name: task.result() for name, task in tasks.items()}
+
+    async def create_travel_plan(self, request: TravelRequest, on_section: Optional[SectionCallback] = None,
+                                 mode: Optional[str] = None, deadline: Optional[float] = None,
+                                 on_item: Optional[ItemCallback] = None) -> dict:
+        """Coordinate all agents to create complete travel plan.
+
+        `on_section` is awaited with each plan section as soon as its agent finishes.
+        Without it, concurrent equivalent requests share one run of the agents.
+        `mode` is "split" or "fused" and defaults to PLAN_EXECUTION_MODE.
+        `deadline` is in seconds, defaults to PLAN_DEADLINE_SECONDS, and 0 means none;
+        sections that missed it are listed in the plan's `degradedSections`.
+        `on_item`, used together with `on_section`, is awaited with each list element
+        of a section as it is generated.
+        """
+        print(f"Creating travel plan for {request.destination}...")
+        mode = mode or PLAN_EXECUTION_MODE
+        mode_token = current_mode.set(mode)
+        deadline_token = current_deadline.set(plan_deadline(PLAN_DEADLINE_SECONDS if deadline is None else deadline))
+        started = time.monotonic()
+        try:
+            if on_section:
+                degraded = set()
+                results = await self._run_steps(request, on_section, degraded=degraded, on_item=on_item)
+            else:
+                results, degraded = await self.run_agents(request)
+        finally:
+            current_mode.reset(mode_token)
+            current_deadline.reset(deadline_token)
+        execution_stats.record_plan(mode, time.monotonic() - started)
+        PLAN_SECONDS.observe(time.monotonic() - started, mode=mode)
+
+        complete_plan = self.record_plan(request, results, degraded)
         print("Travel plan completed!")
         return complete_plan
 
-# Initialize orchestrator
-print("Starting AI Travel Planner API...")
-orchestrator = TravelPlannerOrchestrator()
+    async def run_agents(self, request: TravelRequest) -> Tuple[Dict[str, dict], set]:
+        """Step results and degraded steps for a request, shared with concurrent equivalent requests"""
+        key = f"{current_mode.get()}:{request_key(request)}"
+
+        async def run():
+            degraded = set()
+            return await self._run_steps(request, degraded=degraded), degraded
+
+        return await plan_flights.do("plans", key, run)
+
+    def assemble_plan(self, request: TravelRequest, results: Dict[str, dict]) -> dict:
+        # Combine all results
+        complete_plan = {}
+        for step in self.steps:
+            complete_plan.update(step.fields(request, results[step.name]))
+        return complete_plan
+
+    def record_plan(self, request: TravelRequest, results: Dict[str, dict], degraded: set = frozenset()) -> dict:
+        """Assemble the plan and remember what it was built from so it can be re-planned"""
+        complete_plan = self.assemble_plan(request, results)
+        complete_plan["degradedSections"] = [step.section for step in self.steps if step.name in degraded]
+        complete_plan["planId"] = plan_store.add(request, results, complete_plan)
+        return complete_plan
+
+    def unchanged_steps(self, old_request: TravelRequest, request: TravelRequest) -> set:
+        """Steps whose agent prompt uses exactly the same request fields for both requests"""
+        return {step.name for step in self.steps
+                if step.agent.prompt_inputs(old_request, canonical=False)
+                == step.agent.prompt_inputs(request, canonical=False)}
+
+    async def replan(self, plan_id: str, changes: dict, on_section: Optional[SectionCallback] = None) -> dict:
+        """Apply `changes` to a previous plan's request and re-run only the affected agents"""
+        previous = await asyncio.to_thread(plan_store.get, plan_id)
+        if previous is None:
+            raise KeyError(plan_id)
+
+        request = TravelRequest(**{**previous["request"], **changes})
+        unchanged = self.unchanged_steps(TravelRequest(**previous["request"]), request)
+        # Fallback sections are worth another try
+        unchanged -= {step.name for step in self.steps if step.section in previous["degradedSections"]}
+        print(f"Re-planning {plan_id} for {request.destination}...")
+
+        degraded = set()
+        # Steps that re-run do so because their exact inputs changed, so they skip near-duplicate keys
+        token = exact_inputs.set(True)
+        try:
+            results = await self._run_steps(request, on_section, previous["results"], unchanged, degraded)
+        finally:
+            exact_inputs.reset(token)
+        # Reused results are the previous objects themselves
+        rerun = [name for name, result in results.items() if result is not previous["results"][name]]
+        complete_plan = self.record_plan(request, results, degraded)
+        complete_plan["replannedFrom"] = plan_id
+        complete_plan["rerunAgents"] = rerun
+        return complete_plan
+
+    async def create_travel_plans(self, requests: List[TravelRequest],
+                                  on_plan: Optional[Callable[[int, dict], Awaitable[None]]] = None) -> dict:
+        """Plan a batch of trips, computing each distinct agent input only once.
+
+        Identical requests are grouped and run once; across groups, agents with the same
+        inputs (e.g. one LocalTipsAgent call per destination) share results through the
+        agent cache and single-flight. At most BATCH_MAX_CONCURRENCY groups run at a time.
+        `on_plan` is awaited with (index, plan or error) as each request finishes.
+        """
+        started = time.monotonic()
+        groups: Dict[str, List[int]] = {}
+        for index, request in enumerate(requests):
+            groups.setdefault(request_key(request), []).append(index)
+
+        # Agent calls that remain after deduplication; dependent steps run once per group
+        unique_calls = set()
+        for key, indexes in groups.items():
+            for step in self.steps:
+                if step.deps:
+                    unique_calls.add((step.name, key))
+                else:
+                    unique_calls.add((step.name, step.agent.cache_key(requests[indexes[0]])))
+
+        semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+        plans: List[Optional[dict]] = [None] * len(requests)
+
+        async def run_group(indexes: List[int]):
+            # Each group runs in its own task, so this does not leak to the caller
+            current_priority.set("batch")
+            results, degraded, error = None, set(), None
+            async with semaphore:
+                current_deadline.set(plan_deadline(BATCH_DEADLINE_SECONDS))
+                try:
+                    results, degraded = await self.run_agents(requests[indexes[0]])
+                except Exception as e:
+                    print(f"Error creating travel plan: {str(e)}")
+                    error = f"Error creating travel plan: {str(e)}"
+            for index in indexes:
+                if results is None:
+                    plans[index] = {"error": error}
+                else:
+                    plans[index] = self.record_plan(requests[index], results, degraded)
+                if on_plan:
+                    await on_plan(index, plans[index])
+
+        await asyncio.gather(*(run_group(indexes) for indexes in groups.values()))
+
+        return {
+            "plans": plans,
+            "summary": {
+                "requests": len(requests),
+                "uniqueRequests": len(groups),
+                "agentCalls": len(requests) * len(self.steps),
+                "uniqueAgentCalls": len(unique_calls),
+                "elapsedSeconds": round(time.monotonic() - started, 3)
+            }
+        }
+
+class PrefetchScheduler:
+    """Keeps destination-level agent results warm for the most requested trips.
+
+    Learns the hottest destinations, with their most common durations, traveler counts
+    and interest sets, from the plan store and the legacy JSON plans in logs/. During
+    the off-peak hours it generates or refreshes LocalTipsAgent, AttractionsAgent and
+    RestaurantAgent results that are missing or close to expiring, spending at most
+    PREFETCH_MAX_CALLS model calls per run.
+    """
+    def __init__(self, orchestrator: "TravelPlannerOrchestrator"):
+        self.agents = [orchestrator.tips_agent, orchestrator.attractions_agent, orchestrator.restaurant_agent]
+        self.task: Optional[asyncio.Task] = None
+        self.stats = {"runs": 0, "modelCalls": 0, "alreadyWarm": 0, "lastRun": None}
+
+    def in_off_peak(self) -> bool:
+        start, end = PREFETCH_HOURS
+        hour = datetime.now().hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def history(self) -> List[dict]:
+        requests = plan_store.recent_requests(PREFETCH_HISTORY_DAYS * 24 * 60 * 60, 5000)
+        for path in glob.glob(os.path.join("logs", "travel_plan_*.json")):
+            try:
+                with open(path) as f:
+                    plan = json.load(f)
+                overview = plan.get("overview", {})
+                requests.append({
+                    "destination": plan["destination"],
+                    "startDate": overview.get("startDate", ""),
+                    "endDate": overview.get("endDate", ""),
+                    "travelers": overview.get("travelers", 1),
+                    "interests": [],
+                })
+            except Exception:
+                continue
+        return requests
+
+    def hot_requests(self) -> List[TravelRequest]:
+        """One representative request per hot destination and interest set"""
+        by_trip: Dict[Tuple[str, Tuple[str, ...]], List[dict]] = {}
+        for past in self.history():
+            destination = request_matcher.clean_destination(past.get("destination", ""))
+            if not destination:
+                continue
+            interests = tuple(sorted({i.strip().lower() for i in past.get("interests", []) if i.strip()}))
+            by_trip.setdefault((destination, interests), []).append(past)
+
+        hottest = sorted(by_trip.items(), key=lambda item: len(item[1]), reverse=True)[:PREFETCH_TOP_TRIPS]
+        start = datetime.now() + timedelta(days=30)
+        requests = []
+        for (destination, interests), past in hottest:
+            duration = Tally(calculate_days(p["startDate"], p["endDate"]) for p in past).most_common(1)[0][0]
+            travelers = Tally(p.get("travelers", 1) for p in past).most_common(1)[0][0]
+            requests.append(TravelRequest(
+                destination=destination,
+                startDate=start.strftime("%Y-%m-%d"),
+                endDate=(start + timedelta(days=max(duration, 1))).strftime("%Y-%m-%d"),
+                travelers=travelers,
+                interests=list(interests),
+            ))
+        return requests
+
+    async def run_once(self) -> dict:
+        calls = 0
+        warm = 0
+        token = current_priority.set("prefetch")
+        try:
+            for request in await asyncio.to_thread(self.hot_requests):
+                for agent in self.agents:
+                    if calls >= PREFETCH_MAX_CALLS:
+                        break
+                    remaining = await agent_cache.expires_in(agent.role, agent.cache_key(request))
+                    if remaining is not None and remaining > PREFETCH_REFRESH_BEFORE:
+                        warm += 1
+                        continue
+                    print(f"Prefetch: {agent.role} for {request.destination}")
+                    await agent.refresh(request)
+                    calls += 1
+        finally:
+            current_priority.reset(token)
+
+        self.stats["runs"] += 1
+        self.stats["modelCalls"] += calls
+        self.stats["alreadyWarm"] += warm
+        self.stats["lastRun"] = datetime.now().isoformat()
+        return {"modelCalls": calls, "alreadyWarm": warm}
+
+    async def run_forever(self):
+        while True:
+            if self.in_off_peak():
+                try:
+                    await self.run_once()
+                except Exception as e:
+                    print(f"Prefetch run failed: {str(e)}")
+            await asyncio.sleep(PREFETCH_INTERVAL_SECONDS)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run_forever())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "enabled": PREFETCH_ENABLED, "offPeakHours": list(PREFETCH_HOURS),
+                "maxCallsPerRun": PREFETCH_MAX_CALLS}
+
+class JobWorkers:
+    """Worker tasks in this process that run plan jobs from the shared job queue.
+
+    Idle workers poll every JOB_POLL_SECONDS, or sooner when this process enqueues
+    a job. While a job runs its lease is renewed in the background; on shutdown
+    unfinished jobs go back to the queue for the next worker.
+    """
+    def __init__(self, orchestrator: "TravelPlannerOrchestrator", jobs: JobQueue, size: int):
+        self.orchestrator = orchestrator
+        self.jobs = jobs
+        self.size = size
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.tasks: List[asyncio.Task] = []
+        self.wakeup = asyncio.Event()
+        self.stats = {"completed": 0, "failed": 0}
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.size)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def notify(self):
+        self.wakeup.set()
+
+    async def work(self):
+        while True:
+            try:
+                job = await asyncio.to_thread(self.jobs.claim, self.worker_id)
+            except Exception as e:
+                print(f"Error claiming plan job: {str(e)}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            await self.run(job)
+
+    async def renew_lease(self, job_id: str):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            await asyncio.to_thread(self.jobs.renew, job_id)
+
+    async def run(self, job: dict):
+        job_id = job["jobId"]
+        request = TravelRequest(**job["request"])
+        print(f"Job {job_id}: attempt {job['attempts']} for {request.destination}")
+
+        async def on_section(section: str, fields: dict):
+            await asyncio.to_thread(self.jobs.save_section, job_id, section, fields)
+
+        lease = asyncio.create_task(self.renew_lease(job_id))
+        # Nobody is waiting on the response, so the job's model calls queue behind interactive ones
+        token = current_priority.set("batch")
+        try:
+            travel_plan = await self.orchestrator.create_travel_plan(request, on_section, job["mode"],
+                                                                      JOB_DEADLINE_SECONDS)
+            await asyncio.to_thread(self.jobs.complete, job_id, travel_plan)
+            self.stats["completed"] += 1
+        except asyncio.CancelledError:
+            self.jobs.release(job_id)
+            raise
+        except Exception as e:
+            print(f"Error creating travel plan: {str(e)}")
+            await asyncio.to_thread(self.jobs.fail, job_id, f"Error creating travel plan: {str(e)}")
+            self.stats["failed"] += 1
+        finally:
+            current_priority.reset(token)
+            lease.cancel()
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "worker": self.worker_id, "workers": len(self.tasks)}
+
+# Built by initialize() when a worker starts
+orchestrator: Optional[TravelPlannerOrchestrator] = None
+prefetch_scheduler: Optional[PrefetchScheduler] = None
+job_workers: Optional[JobWorkers] = None
+
+# Seconds spent in each startup phase of this worker
+startup_timings: Dict[str, float] = {}
+
+def record_startup(phase: str, seconds: float):
+    startup_timings[phase] = round(seconds, 3)
+    STARTUP_SECONDS.set(seconds, phase=phase)
+    print(f"Startup: {phase} took {seconds:.3f}s")
+
+def initialize():
+    """Build the model client, caches, stores and agents; later calls do nothing"""
+    global model_client, agent_cache, shared_flights, plan_store, job_queue
+    global orchestrator, prefetch_scheduler, job_workers
+    if orchestrator is not None:
+        return
+    started = time.monotonic()
+    print("Starting AI Travel Planner API...")
+    model_client = ModelClient()
+    agent_cache = AgentCache(AGENT_CACHE_SIZE, AGENT_CACHE_TTL, AGENT_CACHE_DB or None)
+    if AGENT_CACHE_DB:
+        shared_flights = SharedFlight(AGENT_CACHE_DB, SHARED_FLIGHT_LEASE_SECONDS)
+    plan_store = PlanStore(PLAN_STORE_DB, PLAN_HISTORY_SIZE)
+    job_queue = JobQueue(JOB_QUEUE_DB)
+    orchestrator = TravelPlannerOrchestrator()
+    prefetch_scheduler = PrefetchScheduler(orchestrator)
+    job_workers = JobWorkers(orchestrator, job_queue, JOB_WORKERS)
+    record_startup("init", time.monotonic() - started)
+
+# Keys of the complete plan each section fills; `fields` may name a section or one of its keys
+PLAN_SECTIONS = {
+    "overview": ("destination", "duration", "overview"),
+    "transportation": ("transportation",),
+    "accommodation": ("accommodation",),
+    "attractions": ("attractions",),
+    "restaurants": ("restaurants",),
+    "activities": ("activities",),
+    "localTips": ("localTips",),
+}
+# Bookkeeping keys that are returned whatever `fields` asks for
+PLAN_METADATA_FIELDS = ("planId", "degradedSections", "replannedFrom", "rerunAgents", "trace")
+
+def parse_plan_fields(fields: Optional[str]) -> Optional[set]:
+    """The plan keys a comma-separated `fields` parameter selects, or None for the whole plan"""
+    if not fields:
+        return None
+    keys = set(PLAN_METADATA_FIELDS)
+    known = {key for section_keys in PLAN_SECTIONS.values() for key in section_keys}
+    for name in filter(None, (name.strip() for name in fields.split(","))):
+        if name in PLAN_SECTIONS:
+            keys.update(PLAN_SECTIONS[name])
+        elif name in known:
+            keys.add(name)
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown plan field {name!r}; "
+                                                        f"use one of: {', '.join(PLAN_SECTIONS)}")
+    return keys
+
+def project_plan(plan: dict, keys: Optional[set]) -> dict:
+    if keys is None:
+        return plan
+    return {key: value for key, value in plan.items() if key in keys}
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match already names `etag`, by weak comparison"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+class StreamAwareGZipResponder(GZipResponder):
+    """Starlette's gzip responder, except that event streams pass through uncompressed.
+
+    The gzip responder buffers compressed output until it has a full block, which
+    would hold SSE events back until the stream ends.
+    """
+    async def send_with_gzip(self, message):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            if headers.get("content-type", "").startswith("text/event-stream"):
+                # Treated like a response that is already encoded: sent as is
+                self.initial_message = message
+                self.content_encoding_set = True
+                return
+        await super().send_with_gzip(message)
+
+class StreamAwareGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware that answers through StreamAwareGZipResponder"""
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            await StreamAwareGZipResponder(self.app, self.minimum_size, self.compresslevel)(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+if RESPONSE_GZIP_MIN_BYTES > 0:
+    app.add_middleware(StreamAwareGZipMiddleware, minimum_size=RESPONSE_GZIP_MIN_BYTES,
+                       compresslevel=RESPONSE_GZIP_LEVEL)
+
+def format_sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def sse_response(produce: Callable[[SectionCallback], Awaitable[None]]) -> StreamingResponse:
+    """Stream the events `produce` emits as Server-Sent Events until it returns"""
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def emit(event: str, data):
+        await queue.put(format_sse(event, data))
+
+    async def run():
+        try:
+            await produce(emit)
+        finally:
+            await queue.put(None)
+
+    async def events():
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+                yield message
+        finally:
+            # Client went away before the work finished
+            task.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def probe_model_client():
+    """Resolve the agents' models once so the first plan request does not pay for it"""
+    if not (GEMINI_AVAILABLE and GEMINI_API_KEY):
+        return
+    model_names = {agent.model_name for agent in vars(orchestrator).values() if isinstance(agent, Agent)}
+    for model_name in model_names:
+        try:
+            await model_client.probe(model_name)
+        except Exception as e:
+            print(f"Model probe failed for {model_name}: {str(e)}")
+
+# Startup probe, run in the background so a slow or unreachable Gemini does not keep
+# the worker from serving; calls made before it finishes resolve their model themselves
+probe_task: Optional[asyncio.Task] = None
+
+async def run_startup_probe():
+    started = time.monotonic()
+    await probe_model_client()
+    record_startup("probe", time.monotonic() - started)
+
+async def start_services():
+    global probe_task
+    initialize()
+    probe_task = asyncio.create_task(run_startup_probe())
+    if PREFETCH_ENABLED:
+        prefetch_scheduler.start()
+    job_workers.start()
+    record_startup("ready", time.monotonic() - IMPORT_STARTED)
+
+async def stop_services():
+    if probe_task is not None:
+        probe_task.cancel()
+    # Jobs still running go back to the queue
+    await job_workers.stop()
+    prefetch_scheduler.stop()
+    plan_store.close()
 
 # API Endpoints
 @app.get("/")
@@ -494,15 +3110,73 @@ def read_root():
         "version": "1.0",
         "ai_enabled": GEMINI_AVAILABLE and bool(GEMINI_API_KEY),
         "endpoints": {
-            "POST /api/plan-trip": "Create a complete travel plan"
+            "POST /api/plan-trip": "Create a complete travel plan",
+            "POST /api/plan-trip/stream": "Stream plan sections as Server-Sent Events as each agent finishes",
+            "POST /api/jobs": "Queue a travel plan and return a job ID at once",
+            "GET /api/jobs/{job_id}": "Job status, sections finished so far, and the plan once done",
+            "POST /api/plan-trips/batch": "Plan many trips at once, sharing agent calls across requests",
+            "POST /api/plans/{plan_id}/replan": "Change some request fields and re-run only the affected agents",
+            "GET /api/plans": "Search stored plans by destination, start date or request hash",
+            "GET /api/plans/{plan_id}": "Fetch a stored plan",
+            "GET /api/cache/stats": "Agent result cache hit, miss and eviction counts",
+            "GET /api/coalescing/stats": "Plan and agent calls shared between concurrent identical requests",
+            "GET /api/execution-modes/stats": "Latency and estimated token cost of fused versus split plans",
+            "GET /api/prefetch/stats": "Background pre-generation of popular destinations",
+            "POST /api/prefetch/run": "Warm popular destinations now, within the prefetch call budget",
+            "GET /metrics": "Prometheus metrics: per-agent latency, queue wait, tokens, fallbacks and retries"
         }
     }
 
+def validate_mode(mode: Optional[str]):
+    if mode is not None and mode not in EXECUTION_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of: {', '.join(EXECUTION_MODES)}")
+
+def check_admission():
+    """Turn a plan request away up front when it could only queue or fall back.
+
+    503 while the Gemini circuit is open, 429 once ADMISSION_MAX_QUEUE interactive model
+    calls are already waiting; both carry a Retry-After estimate. Batch and prefetch calls
+    do not count, since the scheduler serves the new request's calls ahead of them.
+    """
+    breaker = model_client.breaker
+    if breaker.state == "open":
+        ADMISSION_REJECTED.inc(reason="circuit_open")
+        retry_after = breaker.reset_seconds - (time.monotonic() - breaker.opened_at)
+        raise HTTPException(status_code=503, detail="AI service temporarily unavailable, retry shortly",
+                            headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+    scheduler = model_client.scheduler
+    if scheduler.depth("interactive") >= ADMISSION_MAX_QUEUE:
+        ADMISSION_REJECTED.inc(reason="overloaded")
+        raise HTTPException(status_code=429, detail="Too many trips being planned, retry shortly",
+                            headers={"Retry-After": str(scheduler.retry_after("interactive"))})
+
+@app.middleware("http")
+async def record_request_time(request: Request, call_next):
+    started = time.monotonic()
+    response = await call_next(request)
+    # Label by route template so plan IDs do not create a series each
+    route = request.scope.get("route")
+    path = getattr(route, "path", "unmatched")
+    HTTP_SECONDS.observe(time.monotonic() - started, method=request.method, path=path,
+                         status=response.status_code)
+    return response
+
 @app.post("/api/plan-trip")
-async def plan_trip(request: TravelRequest):
+async def plan_trip(request: TravelRequest, mode: Optional[str] = None, trace: bool = False,
+                    fields: Optional[str] = None):
     """
-    Create a comprehensive travel plan using multi-agent system
+    Create a comprehensive travel plan using multi-agent system.
+
+    `mode` ("split" or "fused") overrides PLAN_EXECUTION_MODE for this request.
+    With `trace`, the response includes a `trace` list of timed step and model-call spans.
+    `fields` (e.g. "overview,activities") limits the response to those plan sections;
+    the whole plan is still generated and stored.
     """
+    validate_mode(mode)
+    keys = parse_plan_fields(fields)
+    check_admission()
+    if trace:
+        current_trace.set({"started": time.monotonic(), "spans": []})
     print("resuqest here ", request)
     try:
         # Validate input
@@ -511,30 +3185,218 @@ async def plan_trip(request: TravelRequest):
             raise HTTPException(status_code=400, detail="Destination is required")
 
         # Create travel plan using orchestrator
-        travel_plan = orchestrator.create_travel_plan(request)
-        os.makedirs("logs", exist_ok=True)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"logs/travel_plan_{timestamp}.json"
-
-        with open(filename, "w") as f:
-            json.dump(travel_plan, f, indent=4)
-
-        print(f"Saved travel plan to: {filename}")
+        travel_plan = await orchestrator.create_travel_plan(request, mode=mode)
+        if trace:
+            travel_plan = {**travel_plan, "trace": current_trace.get()["spans"]}
 
-        return travel_plan
+        return project_plan(travel_plan, keys)
 
     except Exception as e:
         print(f"Error creating travel plan: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error creating travel plan: {str(e)}")
 
+@app.post("/api/plan-trip/stream")
+async def plan_trip_stream(request: TravelRequest, mode: Optional[str] = None):
+    """
+    Stream a travel plan as Server-Sent Events.
+
+    Emits one event per section (overview, transportation, accommodation, attractions,
+    restaurants, activities, localTips) whose data holds that section's plan fields,
+    then a "complete" event with the full plan. While a list section is being
+    generated, "item" events carry {"section", "item"} previews of its elements;
+    the section event that follows is authoritative.
+    """
+    validate_mode(mode)
+    if not request.destination:
+        raise HTTPException(status_code=400, detail="Destination is required")
+    check_admission()
+
+    async def produce(emit: SectionCallback):
+        async def on_item(section: str, item):
+            await emit("item", {"section": section, "item": item})
+
+        try:
+            travel_plan = await orchestrator.create_travel_plan(request, emit, mode, on_item=on_item)
+            await emit("complete", travel_plan)
+        except Exception as e:
+            print(f"Error creating travel plan: {str(e)}")
+            await emit("error", {"detail": f"Error creating travel plan: {str(e)}"})
+
+    return sse_response(produce)
+
+@app.post("/api/jobs", status_code=202)
+async def create_job(request: TravelRequest, mode: Optional[str] = None):
+    """
+    Queue a travel plan without holding the connection open.
+
+    Returns the job ID immediately; poll GET /api/jobs/{job_id} for status, the
+    sections finished so far and, once done, the complete plan. Jobs are durable
+    and run on whichever worker process claims them first.
+    """
+    validate_mode(mode)
+    if not request.destination:
+        raise HTTPException(status_code=400, detail="Destination is required")
+    job_id = await asyncio.to_thread(job_queue.enqueue, request, mode)
+    job_workers.notify()
+    return {"jobId": job_id, "status": "queued", "statusUrl": f"/api/jobs/{job_id}"}
+
+@app.get("/api/jobs/stats")
+async def job_stats():
+    """Jobs by status in the shared queue, and this worker's job runners"""
+    return {"queue": await asyncio.to_thread(job_queue.get_stats), "runners": job_workers.get_stats()}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+@app.post("/api/plan-trips/batch")
+async def plan_trips_batch(batch: BatchTravelRequest):
+    """
+    Plan a batch of trips, deduplicating agent calls across requests.
+
+    Returns {"plans": [...], "summary": {...}} with plans in request order, or with
+    `stream` set, one "plan" Server-Sent Event per request as it finishes followed
+    by a "complete" event carrying the summary.
+    """
+    if not batch.requests:
+        raise HTTPException(status_code=400, detail="At least one request is required")
+    if any(not request.destination for request in batch.requests):
+        raise HTTPException(status_code=400, detail="Destination is required")
+
+    if not batch.stream:
+        return await orchestrator.create_travel_plans(batch.requests)
+
+    async def produce(emit: SectionCallback):
+        async def on_plan(index: int, plan: dict):
+            await emit("plan", {"index": index, "plan": plan})
+
+        try:
+            result = await orchestrator.create_travel_plans(batch.requests, on_plan)
+            await emit("complete", result["summary"])
+        except Exception as e:
+            print(f"Error creating travel plans: {str(e)}")
+            await emit("error", {"detail": f"Error creating travel plans: {str(e)}"})
+
+    return sse_response(produce)
+
+@app.post("/api/plans/{plan_id}/replan")
+async def replan_trip(plan_id: str, changes: TravelRequestUpdate, fields: Optional[str] = None):
+    """
+    Re-plan a previous trip after changing some of its request fields.
+
+    Only agents whose prompt inputs changed are re-run; the rest of the previous
+    plan, including the itinerary when attractions and restaurants are unchanged,
+    is reused. The response lists the re-run agents in `rerunAgents`. `fields`
+    limits the response to those plan sections, as for /api/plan-trip.
+    """
+    keys = parse_plan_fields(fields)
+    # Explicit nulls are kept so a client can clear budget; other fields cannot be cleared
+    updates = changes.dict(exclude_unset=True)
+    cleared = [field for field, value in updates.items() if value is None and field != "budget"]
+    if cleared:
+        raise HTTPException(status_code=400, detail=f"Cannot clear {', '.join(cleared)}")
+    if "destination" in updates and not updates["destination"]:
+        raise HTTPException(status_code=400, detail="Destination is required")
+    try:
+        travel_plan = await orchestrator.replan(plan_id, updates)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Plan {plan_id} not found")
+    except Exception as e:
+        print(f"Error re-planning trip: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error re-planning trip: {str(e)}")
+
+    return project_plan(travel_plan, keys)
+
+@app.get("/api/plans")
+def list_plans(destination: Optional[str] = None, startDate: Optional[str] = None,
+               requestHash: Optional[str] = None, limit: int = 50):
+    """Stored plans, newest first, filtered by destination, start date or request hash"""
+    return {"plans": plan_store.find(destination, startDate, requestHash, min(max(limit, 1), 500))}
+
+@app.get("/api/plans/{plan_id}")
+def get_plan(plan_id: str, request: Request, fields: Optional[str] = None):
+    """
+    A stored plan, optionally limited to the sections named in `fields`.
+
+    Stored plans never change, so the response carries an ETag hashed from its
+    body; a request whose If-None-Match names it gets 304 Not Modified. The ETag
+    is weak because the same tag covers the gzip and identity encodings.
+    """
+    keys = parse_plan_fields(fields)
+    plan_text = plan_store.get_plan_text(plan_id)
+    if plan_text is None:
+        raise HTTPException(status_code=404, detail=f"Plan {plan_id} not found")
+    if keys is not None:
+        plan_text = json.dumps(project_plan(json.loads(plan_text), keys), separators=(",", ":"))
+    body = plan_text.encode()
+    etag = f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+@app.get("/api/cache/stats")
+def cache_stats():
+    return {**agent_cache.get_stats(), "matching": request_matcher.get_stats()}
+
+@app.get("/api/coalescing/stats")
+async def coalescing_stats():
+    return {
+        "plans": plan_flights.get_stats(),
+        "agents": agent_flights.get_stats(),
+        "acrossWorkers": await asyncio.to_thread(shared_flights.get_stats) if shared_flights is not None else None
+    }
+
+@app.get("/api/execution-modes/stats")
+def execution_mode_stats():
+    return {"default": PLAN_EXECUTION_MODE, "modes": execution_stats.get_stats()}
+
+@app.get("/api/prefetch/stats")
+async def prefetch_stats():
+    hot = await asyncio.to_thread(prefetch_scheduler.hot_requests)
+    return {
+        **prefetch_scheduler.get_stats(),
+        "hotTrips": [{"destination": r.destination, "interests": r.interests,
+                      "duration": calculate_days(r.startDate, r.endDate), "travelers": r.travelers} for r in hot]
+    }
+
+@app.post("/api/prefetch/run")
+async def run_prefetch():
+    return await prefetch_scheduler.run_once()
+
+# Metrics and health read scheduler and coalescing state, which belongs to the event loop
+@app.get("/metrics")
+async def metrics():
+    for namespace, counts in agent_cache.get_stats()["agents"].items():
+        for event, value in counts.items():
+            CACHE_EVENTS.set(value, agent=namespace, event=event)
+    for kind, flights in (("plan", plan_flights), ("agent", agent_flights)):
+        for namespace, counts in flights.get_stats()["namespaces"].items():
+            COALESCED_CALLS.set(counts["coalesced"], kind=kind, namespace=namespace)
+    for priority in PRIORITIES:
+        MODEL_QUEUE_DEPTH.set(model_client.scheduler.depth(priority), priority=priority)
+    MODEL_IN_FLIGHT.set(model_client.scheduler.in_flight)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/health")
-def health_check():
+async def health_check():
     return {
         "status": "healthy",
         "agents": 7,
-        "ai_configured": GEMINI_AVAILABLE and bool(GEMINI_API_KEY)
+        "ai_configured": GEMINI_AVAILABLE and bool(GEMINI_API_KEY),
+        "model_client": model_client.get_status(),
+        "startup": startup_timings,
+        "routes": {agent.role: agent.route.to_dict() for agent in vars(orchestrator).values() if isinstance(agent, Agent)},
+        "plan_store": plan_store.get_stats(),
+        # In-memory only; queue counts need the jobs database, see /api/jobs/stats
+        "jobs": job_workers.get_stats()
     }
 
+record_startup("import", time.monotonic() - IMPORT_STARTED)
+
 # Run with: uvicorn main:app --reload --port 8000
 if __name__ == "__main__":
     import uvicorn
@@ -1,30 +1,22 @@
-import google.generativeai as genai
-import os
-from dotenv import load_dotenv
+# Checks which Gemini model name works with the configured API key, using the
+# same probe the backend runs at startup. Candidates come from GEMINI_MODEL_CANDIDATES.
+import asyncio
 
-load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+import main as backend
+from main import GEMINI_MODEL_CANDIDATES
 
-test_models = [
-    "gemini-1.5-flash",
-    "gemini-1.5-pro",
-    "gemini-pro",
-    "models/gemini-1.5-flash",
-    "models/gemini-1.5-pro",
-    "models/gemini-pro",
-    "gemini-1.5-flash-latest",
-    "gemini-1.5-pro-latest"
-]
-
-print("Testing each model name...\n")
-for model_name in test_models:
+async def main():
+    backend.initialize()
+    model_client = backend.model_client
+    print(f"API method: {model_client.method}")
+    print(f"Candidates: {', '.join(GEMINI_MODEL_CANDIDATES)}\n")
     try:
-        print(f"Trying: '{model_name}'")
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content("Say hi in one word")
+        model_name = await model_client.probe(GEMINI_MODEL_CANDIDATES[0])
         print(f"  ✅✅✅ SUCCESS! Use this: '{model_name}'")
-        print(f"  Response: {response.text}\n")
-        break
+        response = await model_client.generate(model_name, "Say hi in one word")
+        print(f"  Response: {response}\n")
     except Exception as e:
-        error_msg = str(e)[:120]
-        print(f"  ❌ Failed: {error_msg}\n")
+        print(f"  ❌ Failed: {str(e)}\n")
+
+if __name__ == "__main__":
+    asyncio.run(main())
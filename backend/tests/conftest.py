@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the backend as `main`, the way uvicorn loads it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,102 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import AttractionsAgent, LocalTipsAgent, TravelRequest
+
+REQUEST = TravelRequest(destination="Rome", startDate="2025-05-01", endDate="2025-05-03", travelers=2)
+
+
+@pytest.fixture
+def failing_model(monkeypatch):
+    async def generate(*args, **kwargs):
+        raise main.CircuitOpenError("Gemini circuit open, failing fast")
+
+    monkeypatch.setattr(main, "model_client", SimpleNamespace(generate=generate))
+    monkeypatch.setattr(main, "agent_cache", main.AgentCache(16, 60))
+    monkeypatch.setattr(main, "shared_flights", None)
+
+
+@pytest.mark.parametrize("agent_class, section", [(AttractionsAgent, "attractions"), (LocalTipsAgent, "localTips")])
+def test_failed_model_call_returns_the_fallback(failing_model, agent_class, section):
+    agent = agent_class()
+    agent.use_ai = True
+    key = agent.cache_key(REQUEST)
+    result, degraded = asyncio.run(agent._generate_result(key, REQUEST))
+    assert degraded
+    assert result == agent.fallback(REQUEST)
+    assert result[section]
+    # Fallbacks are never cached
+    assert asyncio.run(main.agent_cache.get(agent.role, key)) is None
+
+
+def test_preview_errors_do_not_fail_the_model_call(monkeypatch):
+    text = '{"attractions": [{"name": "Colosseum", "bad\tkey": 1}, {"name": "Forum"}]}'
+    calls = []
+
+    async def generate(model_name, prompt, role, on_text=None, generation_config=None):
+        for start in range(0, len(text), 7):
+            await on_text(text[start:start + 7])
+        return text
+
+    def broken_feed(self, chunk):
+        calls.append(chunk)
+        raise ValueError("parser bug")
+
+    monkeypatch.setattr(main, "model_client", SimpleNamespace(generate=generate))
+    monkeypatch.setattr(main.JsonStreamParser, "feed", broken_feed)
+    agent = AttractionsAgent()
+    agent.use_ai = True
+    previews = []
+
+    async def on_item(item):
+        previews.append(item)
+
+    async def run():
+        main.current_step.set({"deadline": float("inf"), "degraded": False, "onItem": on_item})
+        return await agent._complete("prompt")
+
+    assert asyncio.run(run()) == text
+    # Previews stop at the first parser error; the response itself is kept
+    assert len(calls) == 1 and previews == []
+
+
+def test_streamed_previews_survive_malformed_keys(monkeypatch):
+    text = '{"attractions": [{"name": "Colosseum", "bad\tkey": 1}, {"name": "Forum", "x\\q": 2}]}'
+
+    async def generate(model_name, prompt, role, on_text=None, generation_config=None):
+        for start in range(0, len(text), 5):
+            await on_text(text[start:start + 5])
+        return text
+
+    monkeypatch.setattr(main, "model_client", SimpleNamespace(generate=generate))
+    agent = AttractionsAgent()
+    agent.use_ai = True
+    previews = []
+
+    async def on_item(item):
+        previews.append(item)
+
+    async def run():
+        main.current_step.set({"deadline": float("inf"), "degraded": False, "onItem": on_item})
+        return await agent._complete("prompt")
+
+    assert asyncio.run(run()) == text
+    assert previews == [{"name": "Colosseum", "bad\tkey": 1}]
+
+
+def test_long_trips_are_capped_at_max_chunks(monkeypatch):
+    ranges = []
+
+    async def run(request, attractions, restaurants, days):
+        ranges.append(days)
+        return {"activities": [{"day": day} for day in range(days[0], days[1] + 1)]}
+
+    agent = main.ItineraryAgent()
+    monkeypatch.setattr(agent, "run", run)
+    year = TravelRequest(destination="Rome", startDate="2025-01-01", endDate="2025-12-31", travelers=2)
+    itinerary = asyncio.run(agent.create_itinerary(year, [], []))
+    assert len(ranges) == main.ITINERARY_MAX_CHUNKS
+    assert [activity["day"] for activity in itinerary["activities"]] == list(range(1, 365))
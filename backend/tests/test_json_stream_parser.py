@@ -0,0 +1,101 @@
+import pytest
+
+from main import JsonStreamParser, current_parse, load_json_response
+
+
+def stream(text, chunk_size):
+    parser = JsonStreamParser()
+    items = []
+    for start in range(0, len(text), chunk_size):
+        items += parser.feed(text[start:start + chunk_size])
+    return parser, items
+
+
+def test_strict_json_is_returned_as_is():
+    assert load_json_response('{"a": [1, 2]}') == {"a": [1, 2]}
+
+
+def test_numbers_keep_their_separators_after_prose():
+    assert load_json_response('Here: {"a":[1,2]}') == {"a": [1, 2]}
+    assert load_json_response('Result:\n[10, -2.5e3, 7]') == [10, -2500.0, 7]
+
+
+def test_literals_parse():
+    assert load_json_response("Answer: [true, false, null]") == [True, False, None]
+
+
+def test_fences_and_trailing_commas():
+    text = 'Sure!\n```json\n{"a": [1, 2,], "b": {"c": "x",},}\n```\nHope that helps.'
+    assert load_json_response(text) == {"a": [1, 2], "b": {"c": "x"}}
+
+
+def test_bracketed_prose_before_the_value_is_skipped():
+    assert load_json_response('Sure! [JSON below]\n[{"a": 1}, {"b": null}]') == [{"a": 1}, {"b": None}]
+    assert load_json_response('Note {see below}: {"a": 1}') == {"a": 1}
+
+
+def test_strings_with_brackets_and_escapes():
+    text = 'x {"name": "Café [\\"Le Dôme\\"], {open}", "n": 3}'
+    assert load_json_response(text) == {"name": 'Café ["Le Dôme"], {open}', "n": 3}
+
+
+def test_truncated_response_is_salvaged_and_reported():
+    report = {}
+    token = current_parse.set(report)
+    try:
+        data = load_json_response('{"attractions": [{"name": "A", "rating": 4.5}, {"name": "B", "rat')
+    finally:
+        current_parse.reset(token)
+    assert data == {"attractions": [{"name": "A", "rating": 4.5}]}
+    assert report == {"truncated": True}
+
+
+def test_trailing_number_cut_off_mid_stream_is_not_trusted():
+    parser, _ = stream('{"a": [1, 2], "b": 12', 4)
+    assert parser.result() == {"a": [1, 2]}
+    assert parser.truncated
+
+
+def test_nothing_salvageable_raises():
+    with pytest.raises(ValueError):
+        load_json_response("I cannot help with that.")
+    with pytest.raises(ValueError):
+        load_json_response('{"name": "Lou')
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1000])
+def test_streamed_elements_with_scalars(chunk_size):
+    text = ('```json\n{"attractions": [{"coords": [48.8, 2.3], "open": true}, {"rating": 4}], '
+            '"tips": ["a", 5]}\n```')
+    parser, items = stream(text, chunk_size)
+    assert items == [
+        ("attractions", {"coords": [48.8, 2.3], "open": True}),
+        ("attractions", {"rating": 4}),
+        ("tips", "a"),
+        ("tips", 5),
+    ]
+    assert parser.result() == {"attractions": [{"coords": [48.8, 2.3], "open": True}, {"rating": 4}],
+                               "tips": ["a", 5]}
+    assert not parser.truncated
+
+
+def test_top_level_array_elements_stream():
+    _, items = stream('[{"day": 1}, {"day": 2}]', 5)
+    assert items == [(None, {"day": 1}), (None, {"day": 2})]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1000])
+def test_malformed_keys_do_not_stop_the_stream(chunk_size):
+    text = ('{"attractions": [{"name": "Colosseum", "open\thours": "9-19"}, {"name": "Forum", "ba\\qd": 1}], '
+            '"ti\\xps": ["Walk"]}')
+    parser, items = stream(text, chunk_size)
+    assert [item for key, item in items if key == "attractions"] == [
+        {"name": "Colosseum", "open\thours": "9-19"},
+    ]
+    assert ("ti\\xps", "Walk") in items
+    with pytest.raises(ValueError):
+        parser.result()
+
+
+def test_raw_control_characters_in_strings_are_accepted():
+    assert load_json_response('{"name": "Café\tde Flore"}') == {"name": "Café\tde Flore"}
@@ -0,0 +1,217 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from main import CircuitBreaker, ModelScheduler, QueueFullError
+
+
+async def hold(scheduler, priority, order, release):
+    async with scheduler.slot(priority, "test"):
+        order.append(priority)
+        await release.wait()
+
+
+async def queue_behind_one_call(scheduler, priorities):
+    """Start one call that holds the only slot, then queue calls at `priorities`"""
+    order = []
+    release = asyncio.Event()
+    first = asyncio.create_task(hold(scheduler, "prefetch", order, release))
+    await asyncio.sleep(0)
+    order.clear()
+    waiting = [asyncio.create_task(hold(scheduler, priority, order, release)) for priority in priorities]
+    await asyncio.sleep(0)
+    return order, release, [first, *waiting]
+
+
+def test_queued_calls_are_served_most_urgent_first():
+    async def run():
+        scheduler = ModelScheduler(0, 1, 1, 10)
+        order, release, tasks = await queue_behind_one_call(scheduler, ["prefetch", "batch", "interactive", "batch"])
+        assert scheduler.depth() == 4 and scheduler.depth("batch") == 2
+        release.set()
+        await asyncio.gather(*tasks)
+        return order, scheduler
+
+    order, scheduler = asyncio.run(run())
+    assert order == ["interactive", "batch", "batch", "prefetch"]
+    assert scheduler.in_flight == 0 and scheduler.depth() == 0
+
+
+def test_promoted_calls_overtake_less_urgent_ones():
+    async def run():
+        scheduler = ModelScheduler(0, 1, 1, 10)
+        order, release, tasks = await queue_behind_one_call(scheduler, ["batch", "prefetch"])
+        prefetch_future = scheduler.waiting[[entry[0] for entry in scheduler.waiting].index(2)][2]
+        scheduler.promote({prefetch_future}, "interactive")
+        release.set()
+        await asyncio.gather(*tasks)
+        return order, scheduler
+
+    order, scheduler = asyncio.run(run())
+    assert order == ["prefetch", "batch"]
+    assert scheduler.stats["promoted"] == 1
+
+
+def test_coalesced_interactive_caller_promotes_queued_prefetch(monkeypatch):
+    async def run():
+        scheduler = ModelScheduler(0, 1, 1, 10)
+        monkeypatch.setattr(main, "model_client", SimpleNamespace(scheduler=scheduler))
+        flights = main.SingleFlight()
+        order, release, tasks = await queue_behind_one_call(scheduler, ["batch"])
+
+        async def prefetch_call():
+            async with scheduler.slot(main.effective_priority(), "test", main.current_flights.get()):
+                order.append("shared")
+            return {}
+
+        async def prefetch():
+            main.current_priority.set("prefetch")
+            return await flights.do("ns", "key", prefetch_call)
+
+        shared = asyncio.create_task(prefetch())
+        await asyncio.sleep(0.01)
+        joiner = asyncio.create_task(flights.do("ns", "key", prefetch_call))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*tasks, shared, joiner)
+        return order
+
+    assert asyncio.run(run()) == ["shared", "batch"]
+
+
+def test_full_queue_rejects_calls():
+    async def run():
+        scheduler = ModelScheduler(0, 1, 1, 1)
+        _, release, tasks = await queue_behind_one_call(scheduler, ["batch"])
+        with pytest.raises(QueueFullError):
+            async with scheduler.slot("interactive", "test"):
+                pass
+        release.set()
+        await asyncio.gather(*tasks)
+        return scheduler
+
+    assert asyncio.run(run()).stats["rejected"] == 1
+
+
+def test_tokens_refill_at_the_configured_rate_up_to_burst():
+    scheduler = ModelScheduler(60, 5, 1, 10)
+    scheduler.tokens = 0.0
+    scheduler.refilled = time.monotonic() - 1.5
+    scheduler._refill()
+    assert 1.5 <= scheduler.tokens < 1.6
+    scheduler.refilled = time.monotonic() - 60
+    scheduler._refill()
+    assert scheduler.tokens == 5
+
+
+def test_calls_beyond_the_burst_wait_for_a_token():
+    async def run():
+        scheduler = ModelScheduler(600, 1, 4, 10)
+        started = time.monotonic()
+        granted = []
+
+        async def call():
+            async with scheduler.slot("interactive", "test"):
+                granted.append(time.monotonic() - started)
+
+        await asyncio.gather(call(), call())
+        return granted, scheduler
+
+    granted, scheduler = asyncio.run(run())
+    assert granted[0] < 0.05
+    assert granted[1] >= 0.08
+    assert scheduler.stats["throttled"] == 1
+
+
+def test_breaker_opens_and_lets_one_trial_through(monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30)
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    breaker.opened_at -= 31
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    breaker.opened_at -= 31
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+
+
+def test_trial_is_handed_back_when_the_queue_is_full():
+    async def run():
+        client = main.ModelClient()
+        client.method = "fake"
+        client.resolved["m"] = "m"
+        client.breaker.opened_at = time.monotonic() - client.breaker.reset_seconds - 1
+        client.scheduler = ModelScheduler(0, 1, 1, 0)
+        with pytest.raises(QueueFullError):
+            await client.generate("m", "prompt")
+        return client.breaker
+
+    breaker = asyncio.run(run())
+    assert not breaker.trial_in_flight
+    assert breaker.allow()
+
+
+def admission_client(monkeypatch, waiting):
+    """A model client stand-in whose scheduler has `waiting` calls queued, by priority"""
+    scheduler = ModelScheduler(60, 1, 1, 1000)
+    scheduler.tokens = 0.0
+    loop = asyncio.new_event_loop()
+    for priority, count in waiting.items():
+        for _ in range(count):
+            scheduler.waiting.append([main.PRIORITIES[priority], next(scheduler.sequence), loop.create_future()])
+    client = SimpleNamespace(breaker=CircuitBreaker(5, 30), scheduler=scheduler)
+    monkeypatch.setattr(main, "model_client", client)
+    return client
+
+
+def test_admission_ignores_batch_and_prefetch_backlog(monkeypatch):
+    admission_client(monkeypatch, {"batch": 110, "prefetch": 50})
+    main.check_admission()
+
+
+def test_admission_rejects_when_interactive_calls_back_up(monkeypatch):
+    admission_client(monkeypatch, {"interactive": main.ADMISSION_MAX_QUEUE, "batch": 500})
+    with pytest.raises(HTTPException) as rejected:
+        main.check_admission()
+    assert rejected.value.status_code == 429
+    # Only the interactive backlog is ahead of a new request
+    assert rejected.value.headers["Retry-After"] == str(main.ADMISSION_MAX_QUEUE)
+
+
+def test_admission_fails_fast_while_the_circuit_is_open(monkeypatch):
+    client = admission_client(monkeypatch, {})
+    client.breaker.failures = 5
+    client.breaker.opened_at = time.monotonic() - 10
+    with pytest.raises(HTTPException) as rejected:
+        main.check_admission()
+    assert rejected.value.status_code == 503
+    assert rejected.value.headers["Retry-After"] == "20"
+
+
+def test_queued_jobs_call_the_model_at_batch_priority():
+    seen = []
+
+    async def create_travel_plan(*args):
+        seen.append(main.current_priority.get())
+        return {}
+
+    orchestrator = SimpleNamespace(create_travel_plan=create_travel_plan)
+    jobs = SimpleNamespace(complete=lambda job_id, plan: None, renew=lambda job_id: None)
+    workers = main.JobWorkers(orchestrator, jobs, 1)
+    job = {"jobId": "job-1", "attempts": 1, "mode": "parallel",
+           "request": {"destination": "Rome", "startDate": "2025-05-01", "endDate": "2025-05-03", "travelers": 2}}
+    asyncio.run(workers.run(job))
+    assert seen == ["batch"]
+    assert workers.stats["completed"] == 1
@@ -0,0 +1,100 @@
+import pytest
+
+from main import AccommodationAgent, LocalTipsAgent, RequestMatcher, TravelRequest, exact_inputs, request_key
+
+
+@pytest.fixture
+def matcher():
+    return RequestMatcher(0.85, 0.75, max_destinations=8, max_interest_sets=4, max_requests=8)
+
+
+def test_accents_and_aliases_are_folded(matcher):
+    assert matcher.clean_destination("  São  Paulo! ") == "sao paulo"
+    assert matcher.clean_destination("New York City") == "new york"
+
+
+@pytest.mark.parametrize("destination, cleaned", [
+    ("東京", "東京"),
+    ("Москва", "москва"),
+    ("القاهرة", "القاهرة"),
+    ("Zürich", "zurich"),
+])
+def test_non_latin_destinations_keep_their_letters(matcher, destination, cleaned):
+    assert matcher.clean_destination(destination) == cleaned
+
+
+def test_destination_is_never_cleaned_to_empty(matcher):
+    assert matcher.clean_destination("!!!") == "!!!"
+    assert matcher.match_destination("?!") == "?!"
+
+
+def test_non_latin_cities_do_not_share_cache_keys(monkeypatch):
+    monkeypatch.setattr("main.request_matcher", RequestMatcher(0.85, 1.0))
+    agent = LocalTipsAgent()
+    keys = {
+        agent.cache_key(TravelRequest(destination=city, startDate="2025-05-01", endDate="2025-05-04", travelers=2))
+        for city in ("東京", "Москва", "القاهرة")
+    }
+    assert len(keys) == 3
+
+
+def test_typos_match_known_destination(matcher):
+    assert matcher.match_destination("Barcelona") == "barcelona"
+    assert matcher.match_destination("Barcelonna") == "barcelona"
+
+
+def test_fuzzy_match_requires_same_words(matcher):
+    assert matcher.match_destination("Birmingham") == "birmingham"
+    assert matcher.match_destination("Birmingham AL") == "birmingham al"
+    assert matcher.match_destination("Paris Texas") == "paris texas"
+    assert matcher.match_destination("Paris") == "paris"
+
+
+def test_known_destinations_are_bounded(matcher):
+    for i in range(20):
+        matcher.match_destination(f"{chr(ord('a') + i) * 3}{i}ville")
+    assert len(matcher.destinations) == 8
+    indexed = {name for holders in matcher.trigram_index.values() for name in holders}
+    assert indexed == set(matcher.destinations)
+
+
+def test_similar_interest_sets_match(matcher):
+    assert matcher.match_interests(["culture", "food", "history", "nature"]) == ["culture", "food", "history", "nature"]
+    assert matcher.match_interests(["culture", "food", "history", "nature", "art"]) == ["culture", "food", "history", "nature"]
+
+
+def test_interest_sets_and_memo_are_bounded(matcher):
+    for i in range(10):
+        matcher.match_interests([f"interest{i}"])
+    assert len(matcher.interest_sets) == 4
+    for i in range(20):
+        matcher.canonicalize(TravelRequest(destination=f"City {i}", startDate="2025-05-01",
+                                           endDate="2025-05-04", travelers=i + 1))
+    assert len(matcher.memo) == 8
+
+
+def test_one_more_interest_is_a_different_set():
+    matcher = RequestMatcher(0.85, 1.0)
+    assert matcher.match_interests(["culture", "food", "history"]) == ["culture", "food", "history"]
+    assert matcher.match_interests(["culture", "food", "history", "nature"]) == ["culture", "food", "history", "nature"]
+
+
+def test_dates_stay_exact(monkeypatch):
+    monkeypatch.setattr("main.request_matcher", RequestMatcher(0.85, 1.0))
+    may = TravelRequest(destination="Lisbon", startDate="2025-05-01", endDate="2025-05-04", travelers=2)
+    june = TravelRequest(destination="Lisbon", startDate="2025-06-01", endDate="2025-06-04", travelers=2)
+    assert AccommodationAgent().cache_key(may) != AccommodationAgent().cache_key(june)
+    assert request_key(may) != request_key(june)
+
+
+def test_exact_inputs_bypass_near_duplicates(monkeypatch):
+    monkeypatch.setattr("main.request_matcher", RequestMatcher(0.85, 1.0))
+    agent = LocalTipsAgent()
+    known = TravelRequest(destination="Barcelona", startDate="2025-05-01", endDate="2025-05-04", travelers=2)
+    typo = TravelRequest(destination="Barcelonna", startDate="2025-05-01", endDate="2025-05-04", travelers=2)
+    assert agent.cache_key(known) == agent.cache_key(typo)
+    token = exact_inputs.set(True)
+    try:
+        assert agent.cache_key(known) != agent.cache_key(typo)
+    finally:
+        exact_inputs.reset(token)